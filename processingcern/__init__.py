@@ -1,3 +1,11 @@
 from .processingcern import *
 from .lightyield import *
 from .analysis import *
+from .scopecache import *
+from .bootstrap import *
+from .spectrum import *
+from .deferred import *
+from .catalogue import *
+from .memo import *
+from .streaming import *
+from .instrument import *
@@ -1,29 +1,87 @@
 from __future__ import print_function, division
-from numpy import sqrt, ones, array, shape, ptp, var, linspace
+import pandas as pds
+from numpy import sqrt, ones, array, shape, linspace, lexsort, bincount, concatenate, \
+    cumsum, where, add, repeat, errstate, flatnonzero, argsort, zeros, full, nan, stack, einsum
+from numpy.linalg import solve, inv, matrix_rank
 from . import processingcern as pc
-from uncertainties import ufloat, umath
-import scipy.optimize as opt
-from matplotlib.pyplot import subplots, show
+from .lazy import LazyModule, LazyFunction
+
+opt = LazyModule('scipy.optimize')
+ufloat = LazyFunction('uncertainties', 'ufloat')
+subplots = LazyFunction('matplotlib.pyplot', 'subplots')
+show = LazyFunction('matplotlib.pyplot', 'show')
 
 tidystring = lambda astr: '{:1.2f}'.format(astr).replace('+/-', '$\pm$')
 
 
-def CalculatePTP(df):
-    ptpchange = []
-    for key, grp in df.groupby(['SampleB', 'configuration']):
-        astr = [ufloat(a, b) for a, b in zip(grp.CTR, grp.CTRerr)]
-        ptpchange.append(tidystring(ptp(astr)))
+def GroupStatistics(df, by=['SampleB', 'configuration'], value='CTR', error='CTRerr'):
+    '''
+    Peak to peak and standard deviation (ddof=0) of value within each group
+    with first order propagated errors, every group in one pass
+
+    by : columns to group on
+    value, error : columns of the measurement and its uncertainty
+
+    Rows are sorted by group so each statistic is a segment reduction over
+    the group offsets. Ties for the max or min take the last row (as ptp of
+    ufloats does), a group with no spread has a NaN standard deviation error
+
+    returns DataFrame indexed by group of n, ptp, ptperr, std, stderr
+    '''
+    codes = df.groupby(by, sort=True).ngroup().values
+    keep = codes >= 0  # NaN keys are dropped (-1 or NaN codes), as groupby does
+    codes = codes[keep].astype(int)
+    X = df[value].values[keep].astype(float)
+    Xerr = df[error].values[keep].astype(float)
+    Columns = ['n', 'ptp', 'ptperr', 'std', 'stderr']
+    if len(codes) == 0:
+        return pds.DataFrame(columns=Columns)
+
+    # stable sorts by group then value, the last row of a segment is its max (min)
+    Ascending = lexsort((X, codes))
+    Descending = lexsort((-X, codes))
+    n = bincount(codes)
+    offsets = concatenate(([0], cumsum(n)[:-1]))
+    last = offsets + n - 1
+    imax, imin = Ascending[last], Descending[last]
+
+    ptpval = X[imax] - X[imin]
+    ptperr = where(imax == imin, 0.0, sqrt(Xerr[imax] ** 2 + Xerr[imin] ** 2))
+
+    # d std / dx_i = (x_i - mean) / (n std)
+    Xs, Xerrs = X[Ascending], Xerr[Ascending]
+    mean = add.reduceat(Xs, offsets) / n
+    dev = Xs - repeat(mean, n)
+    stdval = sqrt(add.reduceat(dev ** 2, offsets) / n)
+    with errstate(divide='ignore', invalid='ignore'):
+        stderr = sqrt(add.reduceat((dev * Xerrs) ** 2, offsets)) / (n * stdval)
 
-    return ptpchange
+    Keys = df[by].iloc[flatnonzero(keep)[Ascending[offsets]]]
+    Index = pds.MultiIndex.from_arrays([Keys[key].values for key in by], names=by)
+    return pds.DataFrame({'n': n, 'ptp': ptpval, 'ptperr': ptperr,
+                          'std': stdval, 'stderr': stderr}, index=Index, columns=Columns)
 
 
-def CalculateSTD(df):
-    StandardDeviation = []
-    for key, grp in df.groupby(['SampleB', 'configuration']):
-        astr = [ufloat(a, b) for a, b in zip(grp.CTR, grp.CTRerr)]
-        StandardDeviation.append(tidystring(umath.sqrt(var(astr))))
+def CalculatePTP(df, tidy=True, **kwargs):
+    '''
+    Peak to peak CTR change per SampleB and configuration (GroupStatistics)
+    tidy : list of strings for LaTeX, else a DataFrame of ptp, ptperr
+    '''
+    stat = GroupStatistics(df, **kwargs)[['ptp', 'ptperr']]
+    if tidy:
+        return [tidystring(ufloat(a, b)) for a, b in stat.values]
+    return stat
 
-    return StandardDeviation
+
+def CalculateSTD(df, tidy=True, **kwargs):
+    '''
+    Standard deviation of CTR per SampleB and configuration (GroupStatistics)
+    tidy : list of strings for LaTeX, else a DataFrame of std, stderr
+    '''
+    stat = GroupStatistics(df, **kwargs)[['std', 'stderr']]
+    if tidy:
+        return [tidystring(ufloat(a, b)) for a, b in stat.values]
+    return stat
 
 
 def GenerateLaTeXTable(df, sortby=['configuration', 'SampleB', 'DOI'], 
@@ -128,3 +186,82 @@ def getchi(grp, dist='nofit', verbose=0, plot=False, fetchparam=False):
         return param, chi(fitdist)
     else:
         return chi(fitdist)
+
+
+def _DesignMatrix(xdata, degree):
+    '''
+    Columns x**degree ... x, 1 (polyfit order)
+    '''
+    return stack([xdata ** k for k in range(degree, -1, -1)], axis=-1)
+
+
+def BatchedChi(df, by=['SampleB', 'configuration'], dist='nofit', x='DOI', y='CTR',
+               yerr='CTRerr', fetchcov=False):
+    '''
+    Weighted least squares fit of every group at once, as getchi does a group
+    at a time
+
+    by : columns to group on
+    dist : 'nofit' (constant c), 'linear' (m, c) or an int polynomial degree
+    (p<degree> ... p0)
+    fetchcov : also return the (groups, P, P) covariance array
+
+    The weighted normal equations of each group are summed over the group
+    offsets and solved together. Covariances are scaled by chi^2 / (N - P)
+    as curve_fit does without absolute_sigma, chisquared is reduced by N+P-1
+    as getchi does. Groups too small or degenerate to fit are NaN
+
+    returns DataFrame indexed by group of n, the parameters, their errors
+    (<param>err) and chisquared
+    '''
+    if dist == 'nofit':
+        degree, Names = 0, ['c']
+    elif dist == 'linear':
+        degree, Names = 1, ['m', 'c']
+    elif isinstance(dist, int) and dist >= 0:
+        degree, Names = dist, ['p%d' % k for k in range(dist, -1, -1)]
+    else:
+        raise KeyError("Unknown distribution!")
+    P = degree + 1
+
+    Columns = ['n'] + [col for name in Names for col in [name, name + 'err']] + ['chisquared']
+    codes = df.groupby(by, sort=True).ngroup().values
+    keep = flatnonzero(codes >= 0)  # NaN keys are dropped (-1 or NaN codes), as groupby does
+    if len(keep) == 0:
+        Results = pds.DataFrame(columns=Columns)
+        return (Results, zeros((0, P, P))) if fetchcov else Results
+    order = keep[argsort(codes[keep], kind='mergesort')]
+    codes = codes[order].astype(int)
+    n = bincount(codes)
+    offsets = concatenate(([0], cumsum(n)[:-1]))
+
+    X = _DesignMatrix(df[x].values[order].astype(float), degree)
+    Y = df[y].values[order].astype(float)
+    W = 1 / df[yerr].values[order].astype(float) ** 2
+
+    Params = full((len(n), P), nan)
+    Cov = full((len(n), P, P), nan)
+    A = add.reduceat(W[:, None, None] * X[:, :, None] * X[:, None, :], offsets)
+    B = add.reduceat((W * Y)[:, None] * X, offsets)
+    Good = (n >= P) & (matrix_rank(A) == P)
+
+    Params[Good] = solve(A[Good], B[Good][..., None])[..., 0]
+    Residual = Y - einsum('ij,ij->i', X, Params[codes])
+    Chi2 = add.reduceat(W * Residual ** 2, offsets)
+    with errstate(divide='ignore', invalid='ignore'):
+        Cov[Good] = inv(A[Good]) * (Chi2[Good] / (n[Good] - P))[:, None, None]
+    chisquared = Chi2 / (n + P - 1)  # N+P-1
+    chisquared[~Good] = nan
+
+    Keys = df[by].iloc[order[offsets]]
+    Index = pds.MultiIndex.from_arrays([Keys[key].values for key in by], names=by)
+    Results = pds.DataFrame({'n': n}, index=Index)
+    Errors = sqrt(Cov.diagonal(axis1=1, axis2=2))
+    for i, name in enumerate(Names):
+        Results[name] = Params[:, i]
+        Results[name + 'err'] = Errors[:, i]
+    Results['chisquared'] = chisquared
+
+    if fetchcov:
+        return Results, Cov
+    return Results
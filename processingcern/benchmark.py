@@ -0,0 +1,266 @@
+'''
+Benchmarks on synthetic CTR data
+
+Synthetic runs are written in the same F1..F8 ';' separated scope format
+that Fetchfile expects, then the main analysis steps are timed at several
+event counts. Results are appended to a csv so regressions show up.
+
+python -m processingcern.benchmark [resultsfile]
+'''
+from __future__ import print_function, division
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from timeit import default_timer
+import numpy as np
+import pandas as pds
+from . import processingcern as pc
+from .bootstrap import _RandomState
+
+ErrorTypes = ['lsq', 'scikits', 'parametric', 'empirical']
+HeavyModules = ['matplotlib', 'scipy.optimize', 'scipy.stats', 'uncertainties']
+
+
+def SyntheticChannels(Events=10000, LeftPeak=0.6, RightPeak=0.5, PeakWidth=0.03,
+                      ComptonFraction=0.5, Delay=100, Jitter=150, EdgeFraction=0.9,
+                      seed=None):
+    '''
+    Generates every FileNumDict channel for a single run
+
+    Events : number of events
+    LeftPeak, RightPeak : photopeak positions in the left/right energy spectra
+    PeakWidth : photopeak standard deviation
+    ComptonFraction : fraction of events in the Compton continuum
+    Delay, Jitter : mean and standard deviation of the delay (ps)
+    EdgeFraction : fraction of events with a single NINO pulse (2 edges)
+    seed : None, integer or RandomState
+
+    returns dict of channel number : Ampl values
+    '''
+    rng = _RandomState(seed)
+
+    def Energy(Peak):
+        compton = rng.uniform(size=Events) < ComptonFraction
+        # Compton edge of 511 keV sits at 2/3 of the photopeak
+        return np.where(compton, rng.uniform(0, 2 * Peak / 3, Events),
+                        rng.normal(Peak, PeakWidth, Events))
+
+    def Edges():
+        return np.where(rng.uniform(size=Events) < EdgeFraction, 2, 4)
+
+    return {1: Energy(LeftPeak),
+            2: Energy(RightPeak),
+            3: rng.normal(Delay, Jitter, Events) * 1e-12,  # seconds
+            4: rng.normal(10e-9, 1e-9, Events),
+            5: rng.normal(10e-9, 1e-9, Events),
+            7: Edges(),
+            8: Edges()}
+
+
+def WriteScopeFile(filename, Ampl):
+    '''
+    Writes values as an oscilloscope trend file (4 header rows, Time;Ampl)
+    '''
+    with open(filename, 'w') as f:
+        f.write("LECROY,SYNTHETIC,Waveform\n")
+        f.write("Segments,1,SegmentSize," + str(len(Ampl)) + "\n")
+        f.write("Segment,TrigTime,TimeSinceSegment1\n")
+        f.write("#1,01-Aug-2013 00:00:00,0\n")
+        df = pds.DataFrame({'Ampl': Ampl})
+        df.to_csv(f, sep=pc.Seperator, index_label="Time")
+
+
+def GenerateSyntheticDataset(rootloc, Runs=4, length=20, seed=None, Missing=None, **kwargs):
+    '''
+    Writes Runs synthetic runs to rootloc named as the DOI scans
+    (Run_Refvs<length>A_<doi>mm_<segment>) and returns their names
+
+    Missing : dict of channel : number of events the scope missed (dropped
+    from that file, the rest keep their event numbers)
+    remaining kwargs are passed to SyntheticChannels
+    '''
+    if not os.path.exists(rootloc):
+        os.makedirs(rootloc)
+
+    rng = np.random.RandomState(seed)
+    RunNames = []
+    for i in range(Runs):
+        runname = "Run_Refvs%dA_%dmm_%05d" % (length, 2 * i, i + 1)
+        Channels = SyntheticChannels(seed=rng, **kwargs)
+        for j, Ampl in Channels.items():
+            Ampl = pds.Series(Ampl)
+            if Missing and j in Missing:
+                Ampl = Ampl.drop(rng.choice(len(Ampl), Missing[j], replace=False))
+            WriteScopeFile(os.path.join(rootloc, "F" + str(j) + runname + ".txt"), Ampl)
+        RunNames.append(runname)
+    return RunNames
+
+
+def CheckBatchFit(Runs=100, Events=5000, factor=8, seed=0, verbose=0):
+    '''
+    Checks that the batched log-parabola fits (batchfit=True) choose the same
+    photopeak as a curve_fit each (batchfit=False) on the left and right
+    spectra of synthetic runs
+
+    The secondary peak may differ where two Compton shoulder candidates are
+    equally high to within the fits' precision, those are counted apart
+
+    returns list of (run, channel, batched photopeak, curve_fit photopeak)
+    that differ and the number of secondary peak choices that differ
+    '''
+    rng = _RandomState(seed)
+    Mismatches = []
+    Secondary = 0
+    for run in range(Runs):
+        Channels = SyntheticChannels(Events, seed=rng)
+        for j, binrange in [(1, (0.4, 0.8)), (2, (0.2, 0.8))]:
+            Ampl = Channels[j]
+            Ampl = Ampl[(Ampl > binrange[0]) & (Ampl < binrange[1])]
+            freq, edges, _ = pc.Spectrum(binrange, np.floor(np.ptp(binrange) * 2 ** factor)).add(Ampl).nonzero()
+            (Batched, BatchedSecond), (Fitted, FittedSecond) = [
+                [None if peak is None else peak[0]
+                 for peak in pc._RankPhotoPeaks(freq, edges, binrange[0], batchfit=batchfit)]
+                for batchfit in (True, False)]
+            if Batched != Fitted:
+                Mismatches.append((run, j, Batched, Fitted))
+                if verbose > 0:
+                    print("run", run, "channel", j, ":", Batched, "!=", Fitted)
+            Secondary += int(BatchedSecond != FittedSecond)
+    return Mismatches, Secondary
+
+
+def CheckStreamedSelection(workdir=None, Runs=6, Events=6000, Missing=1000, chunksize=700,
+                           seed=0, verbose=0):
+    '''
+    Checks that DelayPeakFitting's streamed path (chunksize) selects and fits
+    the same as the in-memory path for every SelectIndices, on synthetic runs
+    with Missing events dropped from the right energy channel (F2)
+
+    returns list of (run, SelectIndices, in-memory, streamed) that differ, each
+    as (numofsamples, scale, RSPloc) or the failure value
+    '''
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='processingcern-check-')
+    GenerateSyntheticDataset(workdir, Runs=Runs, seed=seed, Missing={2: Missing},
+                             Events=Events, ComptonFraction=0.7)
+    Mismatches = []
+    for uniquename, filenames in zip(*pc.Fetchfile(workdir, skipfirst=False)):
+        for SelectIndices in (0, 1, 2):
+            Results = []
+            for size in (None, chunksize):
+                gi = pc.DelayPeakFitting(filenames, uniquename, GenerateImages=False,
+                                         SelectIndices=SelectIndices, seed=0, chunksize=size)
+                Results.append((gi['numofsamples'], gi['scale'], gi['RSPloc'])
+                               if isinstance(gi, dict) else gi)
+            if Results[0] != Results[1]:
+                Mismatches.append((uniquename, SelectIndices) + tuple(Results))
+                if verbose > 0:
+                    print(uniquename, SelectIndices, ":", Results[0], "!=", Results[1])
+    return Mismatches
+
+
+def _Time(func, repeat=3):
+    '''
+    Best wall time of repeat calls
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        best = min(best, default_timer() - start)
+    return best
+
+
+def ImportTime(module='processingcern', repeat=3):
+    '''
+    Best time to import module in a fresh interpreter (as a pool worker would)
+
+    returns seconds and the HeavyModules the import pulled in
+    '''
+    code = ("import sys, timeit; start = timeit.default_timer(); import " + module +
+            "; print(timeit.default_timer() - start); print(' '.join(sorted(sys.modules)))")
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [env['PYTHONPATH']] if 'PYTHONPATH' in env else [root])
+
+    best = np.inf
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        seconds, modules = output.decode('utf-8').strip().split('\n')[-2:]
+        best = min(best, float(seconds))
+    Loaded = [name for name in HeavyModules if name in modules.split()]
+    return best, Loaded
+
+
+def RunBenchmarks(workdir=None, scales=(1000, 10000, 100000), Runs=4, repeat=3,
+                  resultsfile=None, verbose=0):
+    '''
+    Times the package import (events 0), then Fetchfile (a cold scan and a
+    warm update), RunData (parsing and cached), LocatePhotoPeaks, DelayPeakFitting for every errortype and
+    ProcessFiles end to end on synthetic data with scales events per run
+
+    workdir : where the synthetic data is written (temporary directory)
+    resultsfile : csv the results are appended to
+
+    returns DataFrame of results
+    '''
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='ctrbenchmark')
+
+    CacheLocation = pc.CacheLocation
+    Stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    seconds, Loaded = ImportTime(repeat=repeat)
+    if verbose > 0:
+        print("import :", seconds, "s, loaded", ' '.join(Loaded) or "no heavy modules")
+    Results = [{'timestamp': Stamp, 'benchmark': 'import', 'events': 0,
+                'runs': 0, 'seconds': seconds}]
+    try:
+        for Events in scales:
+            rootloc = os.path.join(workdir, 'events%d' % Events)
+            GenerateSyntheticDataset(rootloc, Runs=Runs, Events=Events, seed=Events)
+
+            pc.CacheLocation = None  # nothing is written outside workdir
+
+            def ColdFetch():
+                pc._Catalogues.clear()  # scans every directory again
+                return pc.Fetchfile(rootloc)
+
+            Timings = [('Fetchfile', _Time(ColdFetch, repeat)),
+                       ('Fetchfile-warm', _Time(lambda: pc.Fetchfile(rootloc), repeat))]
+            UniqueNames, Files = pc.Fetchfile(rootloc, skipfirst=False)
+            un, fs = list(UniqueNames)[0], list(Files)[0]
+            Timings.append(('RunData', _Time(lambda: pc.RunData(fs), repeat)))
+
+            pc.CacheLocation = os.path.join(workdir, 'cache')
+            pc.RunData(fs)  # fills cache
+            Timings += [('RunData-cached', _Time(lambda: pc.RunData(fs), repeat)),
+                        ('LocatePhotoPeaks', _Time(lambda: pc.LocatePhotoPeaks(
+                            fs[1], binrange=(0.4, 0.8)), repeat))]
+
+            for errortype in ErrorTypes:
+                Timings.append(('DelayPeakFitting-' + errortype, _Time(
+                    lambda: pc.DelayPeakFitting(fs, un, errortype=errortype, seed=0), repeat)))
+
+            Timings.append(('ProcessFiles', _Time(
+                lambda: pc.ProcessFiles(rootloc, workingon='benchmark'), repeat)))
+
+            for name, seconds in Timings:
+                if verbose > 0:
+                    print(Events, ":", name, seconds, "s")
+                Results.append({'timestamp': Stamp, 'benchmark': name, 'events': Events,
+                                'runs': Runs, 'seconds': seconds})
+    finally:
+        pc.CacheLocation = CacheLocation
+
+    df = pds.DataFrame(Results, columns=['timestamp', 'benchmark', 'events', 'runs', 'seconds'])
+    if resultsfile is not None:
+        df.to_csv(resultsfile, mode='a', index=False,
+                  header=not os.path.exists(resultsfile))
+    return df
+
+
+if __name__ == "__main__":
+    resultsfile = sys.argv[1] if len(sys.argv) > 1 else 'benchmarks.csv'
+    print(RunBenchmarks(resultsfile=resultsfile, verbose=1))
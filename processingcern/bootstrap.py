@@ -0,0 +1,218 @@
+from __future__ import print_function, division
+import numpy as np
+from .instrument import Instrumented, Count
+from .lazy import LazyModule
+
+__all__ = ['BootstrapSamples', 'BootstrapChunk', 'BCaMeanStd', 'ParametricNormal',
+           'EmpiricalSamples', 'BinnedNormalMLE', 'EmpiricalNormal']
+
+stats = LazyModule('scipy.stats')
+
+BootstrapSamples = 10000  # same default as scikits.bootstrap.ci
+BootstrapChunk = 2 ** 22  # resampled values held in memory at once
+
+
+def _RandomState(seed):
+    '''
+    seed may be None, an integer or an existing RandomState
+    '''
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def _BCaLimits(bootstats, stat, jackstats, alpha):
+    '''
+    BCa confidence limits of a single statistic (as scikits.bootstrap.ci)
+
+    bootstats : sorted bootstrap replicates
+    stat : statistic of the original data
+    jackstats : leave-one-out (jackknife) statistics
+    '''
+    nsamples = len(bootstats)
+
+    # bias correction
+    z0 = stats.norm.ppf(np.sum(bootstats < stat) / nsamples)
+
+    # acceleration
+    jmean = np.mean(jackstats)
+    a = np.sum((jmean - jackstats) ** 3) / \
+        (6.0 * np.sum((jmean - jackstats) ** 2) ** 1.5)
+
+    zs = z0 + stats.norm.ppf([alpha / 2, 1 - alpha / 2])
+    avals = stats.norm.cdf(z0 + zs / (1 - a * zs))
+
+    nvals = np.nan_to_num(np.round((nsamples - 1) * avals)).astype(int)
+    return bootstats[nvals]
+
+
+def _JackknifeMeanStd(data):
+    '''
+    Leave-one-out mean and std from running sums (centred to keep precision)
+    '''
+    N = len(data)
+    centred = data - data.mean()
+    total = centred.sum()
+    totalsq = (centred ** 2).sum()
+    jackmean = (total - centred) / (N - 1)
+    jackvar = (totalsq - centred ** 2) / (N - 1) - jackmean ** 2
+    return jackmean + data.mean(), np.sqrt(np.maximum(jackvar, 0))
+
+
+def _Limits(bootstats, stat, jackstats, alpha, interval):
+    '''
+    Confidence limits from sorted replicates, interval is 'percentile' or 'bca'
+    '''
+    if interval == 'percentile':
+        return tuple(np.percentile(bootstats, [100 * alpha / 2, 100 * (1 - alpha / 2)]))
+    elif interval == 'bca':
+        return tuple(_BCaLimits(bootstats, stat, jackstats, alpha))
+    raise KeyError("Unknown interval " + str(interval))
+
+
+@Instrumented('BCaMeanStd')
+def BCaMeanStd(data, nsamples=None, alpha=0.05, chunksize=None, seed=None):
+    '''
+    BCa bootstrap confidence intervals of the mean and standard deviation
+    Equivalent to scikits.bootstrap.ci(data, mean) and ci(data, std) but both
+    statistics come from one resample index matrix and the jackknife is done
+    in closed form
+
+    nsamples : number of resamples (BootstrapSamples)
+    alpha : intervals are (alpha/2, 1-alpha/2)
+    chunksize : maximum number of resampled values in memory (BootstrapChunk)
+    seed : None, integer or RandomState
+
+    returns (meanlow, meanhigh), (stdlow, stdhigh)
+    '''
+    if nsamples is None:
+        nsamples = BootstrapSamples
+    if chunksize is None:
+        chunksize = BootstrapChunk
+
+    rng = _RandomState(seed)
+    data = np.asarray(data, dtype=float)
+    N = len(data)
+    Count('BCaMeanStd', 'eventsin', N)
+    Count('BCaMeanStd', 'resamples', nsamples)
+
+    bootmean = np.empty(nsamples)
+    bootstd = np.empty(nsamples)
+    rows = max(1, chunksize // N)
+    for start in range(0, nsamples, rows):
+        stop = min(start + rows, nsamples)
+        resample = data[rng.randint(N, size=(stop - start, N))]
+        bootmean[start:stop] = resample.mean(axis=1)
+        bootstd[start:stop] = resample.std(axis=1)
+    bootmean.sort()
+    bootstd.sort()
+
+    jackmean, jackstd = _JackknifeMeanStd(data)
+
+    meanci = _BCaLimits(bootmean, data.mean(), jackmean, alpha)
+    stdci = _BCaLimits(bootstd, data.std(), jackstd, alpha)
+    return tuple(meanci), tuple(stdci)
+
+
+@Instrumented('ParametricNormal')
+def ParametricNormal(loc, scale, N, Runs=500, interval=None, alpha=0.05,
+                     chunksize=None, seed=None):
+    '''
+    Parametric bootstrap of a Normal fit to N samples
+    Runs samples of size N are drawn from Normal(loc, scale) as a (Runs x N)
+    array (chunksize values at a time) and refitted with the closed form
+    MLE estimators (mean and ddof=0 std) along each row
+
+    interval : None returns the mean of the refitted loc and scale
+        'percentile' or 'bca' return (loclow, lochigh), (scalelow, scalehigh)
+        (bca takes its acceleration from the jackknife of one further
+        sample drawn from the fitted distribution)
+    '''
+    if chunksize is None:
+        chunksize = BootstrapChunk
+
+    Count('ParametricNormal', 'resamples', Runs)
+    rng = _RandomState(seed)
+    estloc = np.empty(Runs)
+    estscale = np.empty(Runs)
+    rows = max(1, chunksize // N)
+    for start in range(0, Runs, rows):
+        stop = min(start + rows, Runs)
+        samples = rng.normal(loc, scale, size=(stop - start, N))
+        estloc[start:stop] = samples.mean(axis=1)
+        estscale[start:stop] = samples.std(axis=1)
+
+    if interval is None:
+        return estloc.mean(), estscale.mean()
+
+    estloc.sort()
+    estscale.sort()
+    jackloc, jackscale = _JackknifeMeanStd(rng.normal(loc, scale, size=N))
+    return (_Limits(estloc, loc, jackloc, alpha, interval),
+            _Limits(estscale, scale, jackscale, alpha, interval))
+
+
+def EmpiricalSamples(data, NSamples, NRuns, chunksize=None, seed=None):
+    '''
+    Yields (rows x NSamples) blocks of resamples, NRuns rows in total, drawn
+    from the ECDF of data by inverse-CDF sampling (a single searchsorted of
+    a uniform matrix per block)
+    '''
+    if chunksize is None:
+        chunksize = BootstrapChunk
+
+    rng = _RandomState(seed)
+    xdata = np.sort(np.asarray(data, dtype=float))
+    cdf = np.arange(1, len(xdata) + 1) / len(xdata)
+
+    rows = max(1, chunksize // NSamples)
+    for start in range(0, NRuns, rows):
+        stop = min(start + rows, NRuns)
+        R = rng.uniform(size=(stop - start, NSamples))
+        yield xdata[cdf.searchsorted(R, side='left')]
+
+
+def BinnedNormalMLE(samples, binrange, dt):
+    '''
+    Closed form binned Gaussian MLE of every row of samples
+    Each row is histogrammed over binrange with bin width dt (as
+    numpy.histogram would) and the weighted mean and ddof=0 std of the bin
+    centres are taken. The amplitude is that of normdist (counts x dt)
+
+    returns (rows x 3) array of loc, scale, amplitude
+    '''
+    xmin, xmax = binrange
+    Bins = int(round((xmax - xmin) / dt))
+    rows = samples.shape[0]
+
+    inside = (samples >= xmin) & (samples <= xmax)
+    binindex = ((samples - xmin) * (Bins / (xmax - xmin))).astype(int)
+    # last bin is closed, and Bins is rounded so samples just below xmax may
+    # land a bin past the end when dt doesn't divide binrange
+    binindex = np.minimum(binindex, Bins - 1)
+    binindex += np.arange(rows)[:, None] * Bins
+    freq = np.bincount(binindex[inside], minlength=rows * Bins).reshape(rows, Bins)
+
+    edges = np.linspace(xmin, xmax, Bins + 1)
+    centres = 0.5 * (edges[1:] + edges[:-1])
+
+    total = freq.sum(axis=1)
+    loc = (freq * centres).sum(axis=1) / total
+    scale = np.sqrt((freq * (centres - loc[:, None]) ** 2).sum(axis=1) / total)
+    return np.column_stack((loc, scale, total * dt))
+
+
+@Instrumented('EmpiricalNormal')
+def EmpiricalNormal(data, NRuns=500, binrange=(-500, 500), dt=25,
+                    chunksize=None, seed=None):
+    '''
+    Empirical bootstrap of a binned Gaussian fit : NRuns resamples of data
+    drawn from its ECDF, each reduced with BinnedNormalMLE
+
+    returns (NRuns x 3) array of loc, scale, amplitude
+    '''
+    Count('EmpiricalNormal', 'eventsin', len(data))
+    Count('EmpiricalNormal', 'resamples', NRuns)
+    return np.vstack([BinnedNormalMLE(samples, binrange, dt)
+                      for samples in EmpiricalSamples(data, len(data), NRuns,
+                                                      chunksize=chunksize, seed=seed)])
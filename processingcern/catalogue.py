@@ -0,0 +1,185 @@
+from __future__ import print_function, division
+import os
+import stat
+import json
+import pandas as pds
+
+__all__ = ['ParseRunName', 'RunCatalogue']
+
+
+def ParseRunName(runname):
+    '''
+    Splits Run_<A>vs<B>_<KeyWords>_<Key> into its fields
+    e.g. Run_Refvs20A_10mm_00001 : SampleA Ref, SampleB 20A, KeyWords 10mm, Key 00001
+
+    returns dict of SampleA, SampleB, KeyWords, Key (None when missing)
+    '''
+    Fields = {'SampleA': None, 'SampleB': None, 'KeyWords': None, 'Key': None}
+    Parts = runname.split('_')
+    Rest = Parts[1:]
+    for i, part in enumerate(Parts):
+        if 'vs' in part:
+            Fields['SampleA'], Fields['SampleB'] = part.split('vs', 1)
+            Rest = Parts[i + 1:]
+            break
+
+    # the last field is the Key (segment number) whenever keywords precede it
+    if len(Rest) > 1 or (Rest and Rest[-1].isdigit()):
+        Fields['Key'] = Rest.pop()
+    if Rest:
+        Fields['KeyWords'] = '_'.join(Rest)
+    return Fields
+
+
+def _ScanDirectory(dirname, mtime, cropnum):
+    '''
+    Lists a single directory : subdirectories and channel files (F<j>*.txt)
+    with their mtime and ctime
+    '''
+    Dirs = []
+    Files = {}
+    for name in os.listdir(dirname):
+        try:
+            st = os.stat(os.path.join(dirname, name))
+        except OSError:  # removed while scanning
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if name != '.git':  # don't go into any .git directories
+                Dirs.append(name)
+            continue
+        # skips over guff
+        if name.startswith('input') or name.startswith('output'):
+            continue
+        if name[-3:] == "txt" and name[1:cropnum].isdigit():
+            Files[name] = (st.st_mtime, st.st_ctime)
+    return {'mtime': mtime, 'dirs': sorted(Dirs), 'files': Files}
+
+
+class RunCatalogue(object):
+    '''
+    Index of the oscilloscope runs below rootloc
+
+    runs : run name -> {'files': {channel: path}, 'mtimes': {channel: mtime},
+    'ctimes': {channel: ctime}, plus the ParseRunName fields}
+
+    Files are grouped on the exact run name (filename[cropnum:-4]) so similar
+    names never cross-match. update() only lists directories whose mtime has
+    changed since the last scan, file mtimes are refreshed whenever their
+    directory is. With cachefile the directory listings persist as json
+    '''
+
+    def __init__(self, rootloc, cropnum=2, cachefile=None, verbose=0):
+        self.rootloc = rootloc
+        self.cropnum = cropnum
+        self.cachefile = cachefile
+        self.verbose = verbose
+        self.directories = {}
+        self.runs = {}
+        if cachefile is not None and os.path.exists(cachefile):
+            self.load()
+        self.update()
+
+    def update(self, full=False):
+        '''
+        Rescans changed directories (every directory if full)
+
+        returns number of directories listed
+        '''
+        Directories = {}
+        Rescanned = 0
+        Stack = [self.rootloc]
+        while Stack:
+            dirname = Stack.pop()
+            try:
+                mtime = os.stat(dirname).st_mtime
+            except OSError:
+                continue
+            entry = self.directories.get(dirname)
+            if full or entry is None or entry['mtime'] != mtime:
+                entry = _ScanDirectory(dirname, mtime, self.cropnum)
+                Rescanned += 1
+            Directories[dirname] = entry
+            Stack.extend(os.path.join(dirname, adir) for adir in entry['dirs'])
+
+        Changed = Rescanned > 0 or set(Directories) != set(self.directories)
+        self.directories = Directories
+        if Changed or not self.runs:
+            self._Index()
+        if Changed and self.cachefile is not None:
+            self.save()
+
+        if self.verbose > 0:
+            print("Rescanned", Rescanned, "of", len(Directories), "directories")
+        return Rescanned
+
+    def _Index(self):
+        Runs = {}
+        for dirname in sorted(self.directories):
+            for name, (mtime, ctime) in self.directories[dirname]['files'].items():
+                runname = name[self.cropnum:-4]
+                run = Runs.get(runname)
+                if run is None:
+                    run = dict(ParseRunName(runname), files={}, mtimes={}, ctimes={})
+                    Runs[runname] = run
+                j = int(name[1:self.cropnum])
+                run['files'][j] = os.path.join(dirname, name)
+                run['mtimes'][j] = mtime
+                run['ctimes'][j] = ctime
+        self.runs = Runs
+
+    def select(self, keyword="", skipfirst=False, **fields):
+        '''
+        Sorted run names containing keyword whose parsed fields match fields
+        e.g. select(SampleB='20A')
+
+        skipfirst : ignores 00000 (transitional) runs
+        '''
+        Selected = []
+        for runname in sorted(self.runs):
+            if skipfirst and runname.find("00000") >= 0:
+                continue
+            if runname.find(keyword) < 0:
+                continue
+            run = self.runs[runname]
+            if all(run[key] == val for key, val in fields.items()):
+                Selected.append(runname)
+        return Selected
+
+    def table(self):
+        '''
+        DataFrame of every run : parsed fields, channel count and latest mtime
+        '''
+        Rows = [{'uniquename': runname, 'SampleA': run['SampleA'],
+                 'SampleB': run['SampleB'], 'KeyWords': run['KeyWords'],
+                 'Key': run['Key'], 'channels': len(run['files']),
+                 'mtime': max(run['mtimes'].values())}
+                for runname, run in self.runs.items()]
+        return pds.DataFrame(Rows, columns=['uniquename', 'SampleA', 'SampleB', 'KeyWords',
+                                            'Key', 'channels', 'mtime']).set_index('uniquename').sort_index()
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.cachefile
+        loc = os.path.dirname(filename)
+        if loc and not os.path.exists(loc):
+            os.makedirs(loc)
+        tmpname = filename + '.tmp%d' % os.getpid()
+        with open(tmpname, 'w') as f:
+            json.dump({'rootloc': self.rootloc, 'cropnum': self.cropnum,
+                       'directories': self.directories}, f)
+        os.rename(tmpname, filename)  # concurrent readers never see half a file
+
+    def load(self, filename=None):
+        if filename is None:
+            filename = self.cachefile
+        try:
+            with open(filename) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if (saved['rootloc'], saved['cropnum']) != (self.rootloc, self.cropnum):
+            return
+        # json turns the (mtime, ctime) tuples into lists
+        self.directories = {dirname: dict(entry, files={name: tuple(times)
+                                                        for name, times in entry['files'].items()})
+                            for dirname, entry in saved['directories'].items()}
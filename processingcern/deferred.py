@@ -0,0 +1,125 @@
+'''
+Deferred figure rendering
+
+RecordingFigure stands in for a matplotlib figure: add_subplot, axis calls,
+tight_layout and savefig are recorded as a plain (picklable) plot spec
+instead of being drawn. RenderFigures replays specs later on the Agg
+backend, optionally in a process pool, so fitting never waits on rendering
+or a blocking show()
+'''
+from __future__ import print_function, division
+import os
+from functools import partial
+from multiprocessing import Pool
+
+__all__ = ['TransAxes', 'RecordingAxis', 'RecordingFigure', 'RenderFigure', 'RenderFigures']
+
+TransAxes = 'transAxes'  # stands in for axis.transAxes until rendered
+
+
+class RecordingAxis(object):
+    '''
+    Records every method call made on an axis as (name, args, kwargs)
+    '''
+    transAxes = TransAxes
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+
+class RecordingFigure(object):
+    '''
+    Drop in for figure(**kwargs) that records rather than draws
+    '''
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.clear()
+
+    def add_subplot(self, *args):
+        calls = []
+        self.axes.append((args, calls))
+        return RecordingAxis(calls)
+
+    def tight_layout(self):
+        self.layout = True
+
+    def savefig(self, filename):
+        self.savepaths.append(filename)
+
+    def clear(self):
+        self.axes = []
+        self.layout = False
+        self.savepaths = []
+
+    def spec(self):
+        '''
+        Plot spec passed to RenderFigure
+        '''
+        return {'figure': self.kwargs, 'axes': self.axes,
+                'tight_layout': self.layout, 'savepaths': self.savepaths}
+
+
+def RenderFigure(spec, extensions=None):
+    '''
+    Draws a plot spec on a new Agg figure and saves it
+
+    extensions : only save paths with these extensions (default all)
+
+    returns list of saved paths
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(**spec['figure'])
+    FigureCanvasAgg(fig)
+    for position, calls in spec['axes']:
+        ax = fig.add_subplot(*position)
+        for name, args, kwargs in calls:
+            if kwargs.get('transform') == TransAxes:
+                kwargs = dict(kwargs, transform=ax.transAxes)
+            getattr(ax, name)(*args, **kwargs)
+    if spec['tight_layout']:
+        fig.tight_layout()
+
+    Saved = []
+    for path in spec['savepaths']:
+        if extensions is not None and os.path.splitext(path)[1][1:] not in extensions:
+            continue
+        loc = os.path.dirname(path)
+        if loc and not os.path.exists(loc):
+            os.makedirs(loc)
+        fig.savefig(path)
+        Saved.append(path)
+    return Saved
+
+
+def RenderFigures(specs, workers=1, extensions=None, verbose=0):
+    '''
+    Renders a list of plot specs, in a pool of workers processes if workers > 1
+
+    returns list of saved paths
+    '''
+    render = partial(RenderFigure, extensions=extensions)
+    if workers > 1 and len(specs) > 1:
+        pool = Pool(workers)
+        try:
+            Saved = pool.map(render, specs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        Saved = [render(spec) for spec in specs]
+
+    Saved = [path for paths in Saved for path in paths]
+    if verbose > 0:
+        print("Rendered", len(specs), "figures to", len(Saved), "files")
+    return Saved
@@ -0,0 +1,145 @@
+from __future__ import print_function, division
+import json
+from functools import wraps
+from timeit import default_timer
+import pandas as pds
+
+__all__ = ['Instrumentation', 'EnableInstrumentation', 'DisableInstrumentation', 'Stage',
+           'Count', 'Instrumented']
+
+_Active = None  # Instrumentation currently recording (None when disabled)
+
+
+class Instrumentation(object):
+    '''
+    Wall time and counters (events in/out, fit retries, bootstrap resamples
+    ...) recorded per analysis stage
+
+    Records from different runs or processes are combined with merge() and
+    exported with table() or to_json()
+    '''
+
+    def __init__(self, stages=None):
+        self.stages = {} if stages is None else stages
+
+    def add(self, name, key, n=1):
+        stage = self.stages.setdefault(name, {})
+        stage[key] = stage.get(key, 0) + n
+
+    def merge(self, other):
+        for name, counters in other.stages.items():
+            for key, n in counters.items():
+                self.add(name, key, n)
+        return self
+
+    def table(self):
+        '''
+        DataFrame with a row per stage, slowest first
+        '''
+        df = pds.DataFrame.from_dict(self.stages, orient='index').fillna(0)
+        first = [col for col in ['calls', 'walltime'] if col in df]
+        df = df[first + sorted(col for col in df if col not in first)]
+        if 'walltime' in df:
+            df = df.sort_values('walltime', ascending=False)
+        return df
+
+    def to_json(self, filename=None):
+        # counters can be numpy scalars
+        astr = json.dumps(self.stages, indent=1, sort_keys=True,
+                          default=lambda val: val.item())
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(astr)
+        return astr
+
+    @classmethod
+    def from_json(cls, filename):
+        with open(filename) as f:
+            return cls(json.load(f))
+
+
+class _Stage(object):
+    '''
+    Times a with block and adds counters to a single stage
+    '''
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.record.add(self.name, 'calls')
+        self.record.add(self.name, 'walltime', default_timer() - self.start)
+        return False
+
+    def count(self, key, n=1):
+        self.record.add(self.name, key, n)
+
+
+class _NullStage(object):
+    '''
+    Stand in used while instrumentation is disabled
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def count(self, key, n=1):
+        pass
+
+_NULLSTAGE = _NullStage()
+
+
+def EnableInstrumentation(record=None):
+    '''
+    Starts recording into record (a new Instrumentation by default)
+    '''
+    global _Active
+    _Active = Instrumentation() if record is None else record
+    return _Active
+
+
+def DisableInstrumentation():
+    '''
+    Stops recording and returns what was recorded
+    '''
+    global _Active
+    record, _Active = _Active, None
+    return record
+
+
+def Stage(name):
+    '''
+    with Stage(name) as st: ... times the block and st.count(key, n) adds
+    counters, both do nothing when instrumentation is disabled
+    '''
+    if _Active is None:
+        return _NULLSTAGE
+    return _Stage(_Active, name)
+
+
+def Count(name, key, n=1):
+    if _Active is not None:
+        _Active.add(name, key, n)
+
+
+def Instrumented(name):
+    '''
+    Decorator timing every call of a function as stage name
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _Active is None:
+                return func(*args, **kwargs)
+            with _Stage(_Active, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
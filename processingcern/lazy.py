@@ -0,0 +1,43 @@
+'''
+Stand ins for the heavy dependencies (matplotlib, scipy.optimize,
+scipy.stats, uncertainties) so importing processingcern stays quick in
+batch workers. The real module is imported the first time it is used
+'''
+from __future__ import print_function, division
+import importlib
+
+
+class LazyModule(object):
+    '''
+    Module imported on first attribute access, e.g. stats = LazyModule('scipy.stats')
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):  # copy, pickle ... probing
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        setattr(self, attr, value)  # later lookups skip __getattr__
+        return value
+
+    def __repr__(self):
+        return "<lazy module '" + self._name + "'>"
+
+
+def LazyFunction(modulename, name):
+    '''
+    Function that imports modulename on its first call and forwards to
+    modulename.name, e.g. figure = LazyFunction('matplotlib.pyplot', 'figure')
+    '''
+    module = LazyModule(modulename)
+
+    def wrapper(*args, **kwargs):
+        return getattr(module, name)(*args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = modulename + "." + name + " (imported on first call)"
+    return wrapper
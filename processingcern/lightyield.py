@@ -1,9 +1,11 @@
 from __future__ import print_function, division
 import os
-from scipy import stats
-import scikits.bootstrap as btp
 import pandas as pds
-from numpy import std, mean, floor
+from .bootstrap import BCaMeanStd
+from .lazy import LazyModule
+from numpy import std, mean, floor, asarray
+
+stats = LazyModule('scipy.stats')
 
 
 def normdist(xdata, loc, scale, amp, noise):
@@ -30,11 +32,9 @@ def GetDatLocations(rootloc, verbose=False):
 
 
 def ScikitsBootstrap(fdf):
-    CILower, CIUpper = btp.ci(fdf.counts, std)
-    scaleerr = (CIUpper - std(fdf.counts)) / 1.96
-
-    CILower, CIUpper = btp.ci(fdf.counts, mean)
-    locerr = (CIUpper - mean(fdf.counts)) / 1.96
+    (MeanLower, MeanUpper), (StdLower, StdUpper) = BCaMeanStd(fdf.counts)
+    scaleerr = (StdUpper - std(fdf.counts)) / 1.96
+    locerr = (MeanUpper - mean(fdf.counts)) / 1.96
     amperr = 0  # currently ignored
     return (locerr, scaleerr, amperr)
 
@@ -79,27 +79,43 @@ def LoadData(fileloc, verbose=False):
 
     return defaultparam, df
 
-from uncertainties import ufloat
-
 
 def CalculatePhe(location, locationerr, dB=15, verbose=0):
     '''
     Calculates absolute number of photoelectrons
+    location, locationerr : photopeak location and error, scalars or arrays
+    dB : attenuation, scalar or per location
+
+    The conversion is linear so the error is scaled with the location
     '''
     qe = 1.602E-19  # electron charge
     # Egamma = 0.662 #per MeV
     qch = 160E-15  # C
     # with gain correction factor due to broken dynode
     G = 1.58E7 * (3390 / 4650)
-    NPhe = lambda loc: ((qch * loc * 10 ** (dB / 10)) / (qe * G))
-    Val = NPhe(ufloat(location, locationerr))
-    return floor(Val.n), floor(Val.s)
+    NPhe = lambda loc: ((qch * loc * 10 ** (asarray(dB, dtype=float) / 10)) / (qe * G))
+    Val = NPhe(asarray(location, dtype=float))
+    Err = abs(NPhe(asarray(locationerr, dtype=float)))
+    return floor(Val), floor(Err)
 
 
 def LightOutput(location, locationerr, dB=15):
     '''
-    Absolute Number of photons
+    Absolute Number of photons (scalars or arrays as CalculatePhe)
     '''
     a, b = CalculatePhe(location, locationerr, dB)
     QE = 0.22
     return floor(a * QE), floor(b * QE)
+
+
+def AddLightYield(df, dB=15, location='location', locationerr='locationerr'):
+    '''
+    Adds phe, pheerr, photons and photonserr columns to a results DataFrame
+    (e.g. from FetchDataFrame)
+    dB : attenuation, a number or the name of a per row column
+    '''
+    if isinstance(dB, str):
+        dB = df[dB].values
+    df['phe'], df['pheerr'] = CalculatePhe(df[location].values, df[locationerr].values, dB)
+    df['photons'], df['photonserr'] = LightOutput(df[location].values, df[locationerr].values, dB)
+    return df
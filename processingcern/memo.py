@@ -0,0 +1,133 @@
+from __future__ import print_function, division
+import os
+import hashlib
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from .instrument import Count
+
+__all__ = ['MemoSize', 'MemoLocation', 'CodeVersion', 'MemoCache', 'SharedMemo']
+
+MemoSize = 64  # results held in memory by the shared MemoCache
+MemoLocation = None  # directory the shared MemoCache pickles to (None keeps it in memory)
+_Shared = None
+_CodeVersion = None
+
+
+def CodeVersion():
+    '''
+    sha1 of the package sources, results from other versions are refitted
+    '''
+    global _CodeVersion
+    if _CodeVersion is None:
+        loc = os.path.dirname(os.path.abspath(__file__))
+        sha = hashlib.sha1()
+        for name in sorted(os.listdir(loc)):
+            if name.endswith('.py'):
+                sha.update(name.encode('utf-8'))
+                with open(os.path.join(loc, name), 'rb') as f:
+                    sha.update(f.read())
+        _CodeVersion = sha.hexdigest()
+    return _CodeVersion
+
+
+class MemoCache(object):
+    '''
+    Content addressed cache of per channel stage results (photopeak fits,
+    edge masks ...) keyed by stage name, file fingerprint and the stage's
+    parameters
+
+    maxsize : results held in memory, the least recently used are evicted
+    cacheloc : results are also pickled here so other processes and later
+    sessions can reuse them (None keeps everything in memory)
+    '''
+
+    def __init__(self, maxsize=64, cacheloc=None):
+        self.maxsize = maxsize
+        self.cacheloc = cacheloc
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(stage, fingerprint, **params):
+        # results from other versions of the code are never served
+        astr = repr((stage, fingerprint, sorted(params.items()), CodeVersion()))
+        return hashlib.sha1(astr.encode('utf-8')).hexdigest()
+
+    def _location(self, key):
+        return os.path.join(self.cacheloc, key + '.pkl')
+
+    def get(self, key):
+        '''
+        returns (True, value) or (False, None) if missing
+        '''
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.entries[key] = value  # most recently used
+            return True, value
+
+        if self.cacheloc is not None:
+            try:
+                with open(self._location(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                return False, None
+            self._remember(key, value)
+            return True, value
+        return False, None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.cacheloc is not None:
+            if not os.path.exists(self.cacheloc):
+                try:
+                    os.makedirs(self.cacheloc)
+                except OSError:  # another process made it
+                    pass
+            tmpname = self._location(key) + '.tmp%d' % os.getpid()
+            with open(tmpname, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpname, self._location(key))
+
+    def _remember(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __call__(self, stage, fingerprint, func, *args, **params):
+        '''
+        func(*args, **params) unless the result for stage, fingerprint and
+        params is already cached (args must not change the result, verbose
+        is passed on but isn't part of the key)
+        '''
+        key = self.key(stage, fingerprint, **dict((name, val) for name, val in params.items()
+                                                  if name != 'verbose'))
+        found, value = self.get(key)
+        if found:
+            Count('memo', 'hits')
+            return value
+        Count('memo', 'misses')
+        value = func(*args, **params)
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        '''
+        Empties memory, pickled results are left alone
+        '''
+        self.entries.clear()
+
+
+def SharedMemo():
+    '''
+    MemoCache used when memo=True (one per process, MemoSize and MemoLocation)
+    '''
+    global _Shared
+    if _Shared is None:
+        _Shared = MemoCache(MemoSize, MemoLocation)
+    return _Shared
@@ -1,8 +1,21 @@
 import numpy as np
 from math import pi, log
-import pylab
-from scipy import fft, ifft
-from scipy.optimize import curve_fit
+
+
+# scipy and pylab are only imported when the functions needing them run
+def fft(*args, **kwargs):
+    from scipy import fft as _fft
+    return _fft(*args, **kwargs)
+
+
+def ifft(*args, **kwargs):
+    from scipy import ifft as _ifft
+    return _ifft(*args, **kwargs)
+
+
+def curve_fit(*args, **kwargs):
+    from scipy.optimize import curve_fit as _curve_fit
+    return _curve_fit(*args, **kwargs)
 
 i = 10000
 x = np.linspace(0, 3.5 * pi, i)
@@ -114,8 +127,9 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
         raise ValueError("delta must be a positive number")
 
     # maxima and minima candidates are temporarily stored in
-    # mx and mn respectively
-    mn, mx = np.Inf, -np.Inf
+    # mx and mn respectively (np.inf, np.Inf is gone from NumPy 2 and
+    # _test_fast compares against this function)
+    mn, mx = np.inf, -np.inf
 
     # Only detect peak if there is 'lookahead' amount of points after it
     for index, (x, y) in enumerate(zip(x_axis[:-lookahead],
@@ -128,15 +142,15 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
             mnpos = x
 
         # look for max####
-        if y < mx - delta and mx != np.Inf:
+        if y < mx - delta and mx != np.inf:
             # Maxima peak candidate found
             # look ahead in signal to ensure that this is a peak and not jitter
             if y_axis[index:index + lookahead].max() < mx:
                 max_peaks.append([mxpos, mx])
                 dump.append(True)
                 # set algorithm to only find minima now
-                mx = np.Inf
-                mn = np.Inf
+                mx = np.inf
+                mn = np.inf
                 if index + lookahead >= length:
                     # end is within lookahead no more peaks can be found
                     break
@@ -146,15 +160,15 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
             #    mxpos = x_axis[np.where(y_axis[index:index+lookahead]==mx)]
 
         # look for min####
-        if y > mn + delta and mn != -np.Inf:
+        if y > mn + delta and mn != -np.inf:
             # Minima peak candidate found
             # look ahead in signal to ensure that this is a peak and not jitter
             if y_axis[index:index + lookahead].min() > mn:
                 min_peaks.append([mnpos, mn])
                 dump.append(False)
                 # set algorithm to only find maxima now
-                mn = -np.Inf
-                mx = -np.Inf
+                mn = -np.inf
+                mx = -np.inf
                 if index + lookahead >= length:
                     # end is within lookahead no more peaks can be found
                     break
@@ -176,6 +190,109 @@ def peakdetect(y_axis, x_axis=None, lookahead=300, delta=0):
     return [max_peaks, min_peaks]
 
 
+def _lookahead_extrema(y_axis, lookahead):
+    """
+    Maximum and minimum of y_axis[index:index + lookahead] for every index
+    that the 'peakdetect' loop inspects
+    """
+    y_axis = np.ascontiguousarray(y_axis)
+    windows = np.lib.stride_tricks.as_strided(
+        y_axis, shape=(len(y_axis) - lookahead, lookahead),
+        strides=(y_axis.strides[0], y_axis.strides[0]))
+    return windows.max(axis=1), windows.min(axis=1)
+
+
+def _first_peak(y_axis, ahead, start, end, delta, block):
+    """
+    Runs the maximum search of 'peakdetect' from 'start' with array
+    operations, 'block' points at a time (doubling each time)
+
+    keyword arguments:
+    y_axis -- signal (negate it, and the lookahead minima, to find minima)
+    ahead -- lookahead maximum for every index
+    start, end -- range of indices to search
+    delta -- as 'peakdetect'
+
+    return -- (index the peak was confirmed at, index of the peak) or None
+    """
+    running = -np.inf
+    runpos = start
+    while start < end:
+        stop = min(start + block, end)
+        seg = y_axis[start:stop]
+        mx = np.maximum(np.maximum.accumulate(seg), running)
+        hits = np.nonzero((seg < mx - delta) & (ahead[start:stop] < mx))[0]
+        if len(hits):
+            k = hits[0]
+            # strict '>' in 'peakdetect' keeps the first occurrence
+            if seg[:k + 1].max() > running:
+                runpos = start + seg[:k + 1].argmax()
+            return start + k, runpos
+
+        if seg.max() > running:
+            runpos = start + seg.argmax()
+            running = seg.max()
+        start = stop
+        block *= 2
+    return None
+
+
+def peakdetect_fast(y_axis, x_axis=None, lookahead=300, delta=0):
+    """
+    Gives exactly the same output as 'peakdetect' but jumps from one peak to
+    the next with NumPy array operations rather than stepping through every
+    point of the signal in Python
+
+    keyword arguments:
+    y_axis, x_axis, lookahead, delta -- as 'peakdetect'
+
+    return -- two lists [max_peaks, min_peaks] as 'peakdetect'
+    """
+    max_peaks = []
+    min_peaks = []
+
+    # check input data
+    x_axis, y_axis = _datacheck_peakdetect(x_axis, y_axis)
+    # Only detect peak if there is 'lookahead' amount of points after it
+    end = len(y_axis) - lookahead
+
+    # perform some checks
+    if lookahead < 1:
+        raise ValueError("Lookahead must be '1' or above in value")
+    if not (np.isscalar(delta) and delta >= 0):
+        raise ValueError("delta must be a positive number")
+    if end < 1:
+        return [max_peaks, min_peaks]
+
+    ahead_max, ahead_min = _lookahead_extrema(y_axis, lookahead)
+    # minima are found as maxima of the negated signal
+    searches = {True: (y_axis, ahead_max), False: (-y_axis, -ahead_min)}
+    block = max(4 * lookahead, 64)
+
+    # both searches start together, the first candidate wins (maxima on a tie)
+    hit_max = _first_peak(y_axis, ahead_max, 0, end, delta, block)
+    hit_min = _first_peak(-y_axis, -ahead_min, 0, end, delta, block)
+    find_max = hit_min is None or (hit_max is not None and
+                                   hit_max[0] <= hit_min[0])
+    hit = hit_max if find_max else hit_min
+
+    # the first hit is dropped as 'peakdetect' does
+    first = True
+    while hit is not None:
+        index, pos = hit
+        if not first:
+            peaks = max_peaks if find_max else min_peaks
+            peaks.append([x_axis[pos], y_axis[pos]])
+        first = False
+
+        # alternate between maxima and minima
+        find_max = not find_max
+        signal, ahead = searches[find_max]
+        hit = _first_peak(signal, ahead, index + 1, end, delta, block)
+
+    return [max_peaks, min_peaks]
+
+
 def peakdetect_fft(y_axis, x_axis, pad_len=5):
     """
     Performs a FFT calculation on the data and zero-pads the results to
@@ -266,6 +383,7 @@ def peakdetect_fft(y_axis, x_axis, pad_len=5):
     #pylab.plot(range(len(fft_data)), fft_data)
     # pylab.show()
 
+    import pylab
     pylab.plot(x_axis, y_axis)
     pylab.hold(True)
     pylab.plot(x_axis_ifft, y_axis_ifft)
@@ -665,6 +783,30 @@ def _test():
     _max, _min = peakdetect(y, x, delta=0.30)
 
 
+def _test_fast(runs=100, seed=0):
+    """
+    Differential test of 'peakdetect_fast' against 'peakdetect' on synthetic
+    energy spectra (photopeak, Compton continuum and Poisson noise) and on
+    the module's test signal
+    """
+    rng = np.random.RandomState(seed)
+    cases = [(y, x, 300, 0), (y, x, 300, 0.30), (y, x, 750, 0.30)]
+    for _ in range(runs):
+        bins = rng.randint(20, 2000)
+        edges = np.linspace(0.1, 1, bins + 1)
+        centres = 0.5 * (edges[1:] + edges[:-1])
+        spectrum = (5000 * np.exp(-0.5 * ((centres - rng.uniform(0.4, 0.8)) /
+                                          rng.uniform(0.02, 0.1)) ** 2) +
+                    500 * (centres < rng.uniform(0.3, 0.6)) + 20)
+        freq = rng.poisson(spectrum * 100. / bins)
+        cases.append((freq, centres, rng.randint(1, 40), rng.randint(0, 3) * 5))
+
+    for y_axis, x_axis, lookahead, delta in cases:
+        expected = peakdetect(y_axis, x_axis, lookahead, delta)
+        result = peakdetect_fast(y_axis, x_axis, lookahead, delta)
+        assert result == expected, (lookahead, delta, result, expected)
+
+
 def _test_graph():
     i = 10000
     x = np.linspace(0, 3.7 * pi, i)
@@ -680,6 +822,7 @@ def _test_graph():
     yn = [p[1] for p in _min]
 
     ##plot = pylab.plot(x, y)
+    import pylab
     pylab.hold(True)
     pylab.plot(xm, ym, 'r+')
     pylab.plot(xn, yn, 'g+')
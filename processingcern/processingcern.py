@@ -1,21 +1,46 @@
 from __future__ import print_function, division
 import os
+import hashlib
+import itertools
+import traceback
+from timeit import default_timer
+from multiprocessing import Pool, cpu_count
 from pandas import read_csv, DataFrame
 import pandas as pds
 from numpy import histogram, sqrt, linspace, mean, random, array, floor, ptp, std
-from scipy.optimize import curve_fit
-from scipy import stats
-from uncertainties import ufloat
-import uncertainties.umath as uncmath
-from matplotlib.pyplot import figure, show
-import statsmodels.api as sm
-import scikits.bootstrap as btp
+from numpy import exp, log, pi, ones, column_stack, dot, diag, inf, zeros
+from numpy import einsum, stack, eye, where, errstate, isnan, isfinite, concatenate, nan
+from numpy.linalg import lstsq, solve, inv, LinAlgError
 from . import peakdetect as pkd
+from .lazy import LazyModule, LazyFunction
+from .bootstrap import BCaMeanStd, ParametricNormal, EmpiricalNormal, EmpiricalSamples
+from .scopecache import LoadCachedChannel, RunFingerprint
+from .spectrum import Spectrum
+from .deferred import RecordingFigure, RenderFigure, RenderFigures
+from .catalogue import RunCatalogue
+from .memo import MemoCache, SharedMemo, CodeVersion
+from . import streaming
+from .streaming import StreamRun
+from .instrument import Instrumentation, Instrumented, Stage, Count
+from .instrument import EnableInstrumentation, DisableInstrumentation
+
+# heavy dependencies are imported on first use (see lazy.py)
+stats = LazyModule('scipy.stats')
+uncmath = LazyModule('uncertainties.umath')
+curve_fit = LazyFunction('scipy.optimize', 'curve_fit')
+ufloat = LazyFunction('uncertainties', 'ufloat')
+figure = LazyFunction('matplotlib.pyplot', 'figure')
+show = LazyFunction('matplotlib.pyplot', 'show')
 
 # ImageSaveLocation = os.getcwd()+'/images' ##Final Location
 ImageSaveLocation = '/home/mbrown/Desktop/tmpimages'  # Temporary Location
 Extensions = ['png', 'pdf', 'svg']
 Seperator = ';'
+# parsed scope files are cached here as .npy arrays (None disables caching)
+CacheLocation = os.path.join(os.path.expanduser('~'), '.cache', 'processingcern')
+CacheSize = 10 * 2 ** 30  # bytes, least recently used channels are evicted beyond this
+CombineChunkSize = 100000  # rows held in memory at once by CombineFiles
+CombineStride = 10 ** 9  # combined event key is segment * CombineStride + event
 
 FileNumDict = {1: "Maximum Left SiPM Signal",
                2: "Maximum Right SiPM Signal",
@@ -37,52 +62,54 @@ def MatchFile(fn, keywords):
     return Flag
 
 
+_Catalogues = {}  # RunCatalogue of every rootloc seen by Fetchfile
+
+
+def FetchCatalogue(rootloc, cropnum=2, verbose=0):
+    '''
+    Up to date RunCatalogue of rootloc. Catalogues are kept between calls
+    (and saved in CacheLocation when set) so only changed directories are
+    listed again
+    '''
+    key = (rootloc, cropnum)
+    catalogue = _Catalogues.get(key)
+    if catalogue is None:
+        cachefile = None
+        if CacheLocation is not None:
+            name = hashlib.sha1(os.path.abspath(rootloc).encode('utf-8')).hexdigest()
+            cachefile = os.path.join(CacheLocation, 'catalogue-' + name + '.json')
+        catalogue = RunCatalogue(rootloc, cropnum=cropnum, cachefile=cachefile, verbose=verbose)
+        _Catalogues[key] = catalogue
+    else:
+        catalogue.update()
+    return catalogue
+
+
 def Fetchfile(rootloc, keyword="", cropnum=2, skipfirst=True, verbose=0):
     '''
     New fetch file which will group files in 7 and return everything within this directory!
+
+    Files are grouped on their exact run name by a RunCatalogue (see FetchCatalogue)
+    returns run names and dicts of channel : file location
     '''
-    FullLocation = []
-    Files = []
-    RunNames = []
-
-    # http://stackoverflow.com/questions/120656/directory-listing-in-python
-    for dirname, dirnames, filenames in os.walk(rootloc):
-        for filename in filenames:
-            # skips over guff
-            if filename.startswith('input') or filename.startswith('output'):
-                continue
-            if filename[-3:] == "txt":
-                RunNames.append(filename[cropnum:-4])
-                Files.append(filename)
-                FullLocation.append(os.path.join(dirname, filename))
-
-        # Advanced usage:
-        # editing the 'dirnames' list will stop os.walk() from recursing into
-        # there.
-        if '.git' in dirnames:
-            # don't go into any .git directories.
-            dirnames.remove('.git')
+    catalogue = FetchCatalogue(rootloc, cropnum=cropnum, verbose=verbose)
 
     FullDetails = []
-    for i, afile in enumerate(set(RunNames)):
+    for i, afile in enumerate(catalogue.select(keyword)):
 
         # ignores transitional files
         if skipfirst and afile.find("00000") >= 0:
             print("skipping", afile)
             continue
-        if afile.find(keyword) < 0:
-            continue
 
         if verbose > 0:
             print(i, ":", afile)
 
-        fs = filter(lambda filename: filename.find(afile) > 0, Files)
-        fls = filter(lambda filename: filename.find(afile) > 0, FullLocation)
         # grouped files
-        fs = {int(fn[1]): fullloc for fn, fullloc in zip(fs, fls)}
+        fs = dict(catalogue.runs[afile]['files'])
 
         if verbose > 0:
-            for j in range(1, 6) + [7, 8]:
+            for j in sorted(fs):
                 print(i, ":", afile, fs[j])
 
         FullDetails.append([afile, fs])
@@ -90,45 +117,72 @@ def Fetchfile(rootloc, keyword="", cropnum=2, skipfirst=True, verbose=0):
     return zip(*FullDetails)
 
 
-def CombineFiles(rootloc, splitby='_0', verbose=0):
+def CombineFiles(rootloc, splitby='_0', chunksize=None, verbose=0):
     '''
     Combines files generated by oscilloscope with matching rootnames
     Ignores the first file as this is transitional with temperature
+
+    Segments are streamed into the combined file chunksize rows at a time
+    (CombineChunkSize by default) so memory is bounded by a single chunk.
+    Events are keyed by the integer segment * CombineStride + event so they
+    stay unique across segments
+
+    A run whose segments are unchanged since it was last combined (their
+    fingerprints are kept in combined.sha1) isn't rewritten, so incremental
+    ProcessFiles can reuse its fit
     '''
+    if chunksize is None:
+        chunksize = CombineChunkSize
+
     UniqueNames, Files = Fetchfile(rootloc, verbose=0)  # all files, grouped
+    Runs = list(zip(UniqueNames, Files))
 
     SameName = set([val.split(splitby)[0]
-                   for val in UniqueNames])  # all unique files
+                   for val, afile in Runs])  # all unique files
 
     for rootname in SameName:
         if verbose > 0:
             print(rootname)
-        fFiles = [afile for afile in Files if afile[3].find(rootname) >= 0]
-        for j in range(1, 6) + [7, 8]:
-            for i, filename in enumerate(fFiles):
-                if filename[j].find('_00000') >= 0:  # skips transition file
-                    continue
+        # sorted so segment numbers follow the scope's file numbering
+        fFiles = sorted([afile for val, afile in Runs if val.split(splitby)[0] == rootname],
+                        key=lambda afile: afile[3])
+
+        newloc = rootloc + "-Combined/" + rootname[4:]
+        if not os.path.exists(newloc):
+            os.makedirs(newloc)
+
+        CombinedFiles = [newloc + "/F" + str(j) + "Run_" + rootname[4:] + ".txt"
+                         for j in sorted(FileNumDict)]
+        fingerprint = hashlib.sha1(repr(([RunFingerprint(afile) for afile in fFiles],
+                                         CombineStride)).encode('utf-8')).hexdigest()
+        fingerprintfile = os.path.join(newloc, 'combined.sha1')
+        try:
+            with open(fingerprintfile) as f:
+                Unchanged = f.read() == fingerprint
+        except IOError:
+            Unchanged = False
+        if Unchanged and all(os.path.exists(afile) for afile in CombinedFiles):
+            if verbose > 0:
+                print(rootname, "is already combined")
+            continue
+        if os.path.exists(fingerprintfile):  # a half written combination is never trusted
+            os.remove(fingerprintfile)
 
-                df = pds.read_csv(
-                    filename[j],
-                    skiprows=4,
-                    sep=";",
-                    index_col=0)
-                df.index = [str(val) + "-" + str(i) for val in df.index]
-                if i == 0:
-                    fdf = df
-                else:
-                    fdf = fdf.append(df)
+        for j, combinedfile in zip(sorted(FileNumDict), CombinedFiles):
+            with open(combinedfile, 'w') as f:
+                header = True
+                for i, filename in enumerate(fFiles):
+                    if filename[j].find('_00000') >= 0:  # skips transition file
+                        continue
 
-                fileloc, fn = os.path.split(filename[3])
+                    for df in pds.read_csv(filename[j], skiprows=4, sep=Seperator,
+                                           index_col=0, chunksize=chunksize):
+                        df.index = i * CombineStride + df.index.values.astype('int64')
+                        df.to_csv(f, sep=Seperator, header=header, index_label="Time")
+                        header = False
 
-            newloc = rootloc + "-Combined/" + rootname[4:]
-            if not os.path.exists(newloc):
-                os.makedirs(newloc)
-            fdf.to_csv(
-                newloc + "/F" + str(j) + "Run_" + rootname[4:] + ".txt",
-                sep=";",
-                header="Time;Ampl")
+        with open(fingerprintfile, 'w') as f:
+            f.write(fingerprint)
 
 
 def WhenWasTheFileCreated(rootloc, verbose=0):
@@ -136,13 +190,13 @@ def WhenWasTheFileCreated(rootloc, verbose=0):
     Returns a dataframe containing the creation and modification
     dates of the files within the directory
     '''
-    filedata = Fetchfile(rootloc, verbose=verbose)
+    catalogue = FetchCatalogue(rootloc, verbose=verbose)
 
-    TimeData = [{"uniquename": un,
-                 "mtime": os.path.getmtime(
-                     fn[3]),
-                 "ctime":os.path.getctime(fn[3])} for un,
-                fn in zip(*filedata)]
+    # a live stat, the catalogue misses files rewritten in place
+    TimeData = []
+    for un in catalogue.select(skipfirst=True):
+        st = os.stat(catalogue.runs[un]['files'][3])
+        TimeData.append({"uniquename": un, "mtime": st.st_mtime, "ctime": st.st_ctime})
     df = DataFrame(TimeData)
     df.ctime *= 1e9
     df.ctime = df.ctime.apply(pds.Timestamp)
@@ -152,6 +206,68 @@ def WhenWasTheFileCreated(rootloc, verbose=0):
     return df
 
 
+def LoadChannel(afile, SkipRows=4, columns=None, verbose=0):
+    '''
+    Reads a single oscilloscope channel file (indexed by event)
+    A DataFrame (e.g. from RunData.channel) is passed straight through
+
+    Goes through the binary cache at CacheLocation unless it is None, which
+    is kept under CacheSize bytes
+    '''
+    if isinstance(afile, DataFrame):
+        return afile
+    with Stage('LoadChannel') as st:
+        if CacheLocation is not None:
+            df = LoadCachedChannel(afile, CacheLocation, SkipRows=SkipRows,
+                                   columns=columns, sep=Seperator, maxsize=CacheSize,
+                                   verbose=verbose)
+        else:
+            df = read_csv(afile, skiprows=SkipRows, sep=Seperator, index_col=0)
+            if columns is not None:
+                df = df[columns]
+        st.count('eventsout', len(df))
+    return df
+
+
+class RunData(object):
+    '''
+    Every channel of a single run, read once and held on a shared event axis
+
+    filenames : Dict of filenames generated by FetchFile
+    channels : channels to load (defaults to all of FileNumDict)
+    SkipRows : cropped guff out of data files
+    '''
+
+    def __init__(self, filenames, channels=None, SkipRows=4, verbose=0):
+        if channels is None:
+            channels = sorted(FileNumDict)
+
+        self.filenames = filenames
+        self.SkipRows = SkipRows
+
+        # outer join on the event index, missing events are NaN
+        self.data = pds.concat(
+            [LoadChannel(filenames[j], SkipRows, columns=['Ampl'], verbose=verbose).Ampl
+             for j in channels],
+            axis=1, keys=list(channels))
+
+        if verbose > 0:
+            print("Loaded", len(self.data), "events from", len(channels), "channels")
+
+    def __len__(self):
+        return len(self.data)
+
+    def channel(self, j, aligned=False):
+        '''
+        returns channel j as a DataFrame with an Ampl column (as read_csv would)
+        aligned : keep every event of the run (NaN where channel j missed it)
+        so boolean masks from different channels line up
+        '''
+        if aligned:
+            return DataFrame({'Ampl': self.data[j]})
+        return DataFrame({'Ampl': self.data[j].dropna()})
+
+
 def normdist(xdata, loc, scale, amp):
     '''
     Shifted Normal distribution
@@ -163,13 +279,98 @@ def normdistwithnoise(xdata, loc, scale, amp, noise):
     return amp * stats.norm(loc, scale).pdf(xdata) + noise
 
 
+def gaussian(xdata, loc, scale, amp):
+    '''
+    Shifted Normal distribution in plain NumPy (same as normdist)
+    '''
+    return amp / (scale * sqrt(2 * pi)) * exp(-0.5 * ((xdata - loc) / scale) ** 2)
+
+
+def gaussfit(xdata, ydata, yerr=None, iterations=20, verbose=0):
+    '''
+    Weighted least squares fit of gaussian() without scipy.optimize
+
+    Starts from a parabola fitted to log(ydata) weighted by ydata**2
+    (Caruana's method) then takes Levenberg-Marquardt steps using the
+    analytic Jacobian. No random restarts are needed.
+
+    returns (param, cov) as curve_fit would (cov scaled by the reduced
+    chi squared) or (None, None) if the data isn't peaked
+    '''
+    xdata = array(xdata, dtype=float)
+    ydata = array(ydata, dtype=float)
+    sigma = ones(len(xdata)) if yerr is None else array(yerr, dtype=float)
+
+    # Caruana : log(y) = a + b x + c x**2, centred on xc for conditioning
+    positive = ydata > 0
+    if positive.sum() < 3:
+        return None, None
+    X = xdata[positive]
+    Y = ydata[positive]
+    xc = (X * Y).sum() / Y.sum()
+    design = column_stack((ones(len(X)), X - xc, (X - xc) ** 2))
+    (a, b, c), _, _, _ = lstsq(design * Y[:, None], log(Y) * Y, rcond=-1)
+    if c >= 0:
+        if verbose > 0:
+            print("log-parabola opens upwards, no peak")
+        return None, None
+    scale = sqrt(-0.5 / c)
+    loc = xc - b / (2 * c)
+    amp = exp(a - b ** 2 / (4 * c)) * scale * sqrt(2 * pi)
+    param = array([loc, scale, amp])
+
+    def Jacobian(param):
+        loc, scale, amp = param
+        f = gaussian(xdata, loc, scale, amp)
+        z = (xdata - loc) / scale
+        return f, column_stack((f * z / scale, f * (z ** 2 - 1) / scale, f / amp)) / sigma[:, None]
+
+    f, J = Jacobian(param)
+    residual = (ydata - f) / sigma
+    chisq = dot(residual, residual)
+    damping = 1e-3
+    for _ in range(iterations):
+        A = dot(J.T, J)
+        g = dot(J.T, residual)
+        try:
+            step = solve(A + damping * diag(diag(A)), g)
+        except LinAlgError:
+            break
+        trial = param + step
+        if trial[1] <= 0:
+            damping *= 10
+            continue
+        trialf, trialJ = Jacobian(trial)
+        trialresidual = (ydata - trialf) / sigma
+        trialchisq = dot(trialresidual, trialresidual)
+        if trialchisq < chisq:
+            converged = chisq - trialchisq <= 1e-10 * chisq
+            param, J, residual, chisq = trial, trialJ, trialresidual, trialchisq
+            damping /= 10
+            if converged:
+                break
+        else:
+            damping *= 10
+
+    dof = len(xdata) - len(param)
+    try:
+        cov = inv(dot(J.T, J)) * (chisq / dof if dof > 0 else inf)
+    except LinAlgError:
+        return None, None
+    return param, cov
+
+
+@Instrumented('normfit')
 def normfit(xdata, ydata, yerr=None, ScaleGuess=0.05,
-            PeakGuess=None, failedfitmax=5, verbose=0):
+            PeakGuess=None, failedfitmax=5, backend='curvefit', verbose=0):
     '''
     Shifted Normal distribution fit using stats.curve_fit()
     (Least squared fit)
 
     Will attempt to fit multiple times before giving up
+
+    backend : 'curvefit' or 'fast' which uses gaussfit() and only falls
+    back to curve_fit if that fails
     '''
 
     FailedToFitCounter = 0
@@ -179,6 +380,16 @@ def normfit(xdata, ydata, yerr=None, ScaleGuess=0.05,
             print("No data has been passed to function")
         return (None, None), None
 
+    if backend == 'fast':
+        param, err = gaussfit(xdata, ydata, yerr=yerr, verbose=verbose)
+        if param is not None:
+            return _normfitresult(xdata, ydata, param, err, verbose)
+        Count('normfit', 'fallbacks')
+        if verbose > 0:
+            print("fast fit failed, trying curve_fit")
+    elif backend != 'curvefit':
+        raise KeyError("Unknown backend " + str(backend))
+
     if PeakGuess is None:
         x0 = [xdata[ydata.argmax()], ScaleGuess, 1]  # initial parameter guess
     else:
@@ -188,6 +399,7 @@ def normfit(xdata, ydata, yerr=None, ScaleGuess=0.05,
         if verbose > 0:
             print("beginning run", FailedToFitCounter)
         if FailedToFitCounter >= failedfitmax:
+            Count('normfit', 'failures')
             if verbose > 0:
                 print("All fits failed")
             return (None, None), None
@@ -216,7 +428,15 @@ def normfit(xdata, ydata, yerr=None, ScaleGuess=0.05,
                   ScaleGuess * random.uniform(0.5, 5), 1]
 
         FailedToFitCounter += 1
+        Count('normfit', 'retries')
 
+    return _normfitresult(xdata, ydata, param, err, verbose)
+
+
+def _normfitresult(xdata, ydata, param, err, verbose=0):
+    '''
+    Adds the chi squared test value to a normfit result
+    '''
     p1, p2, p3 = param
     chival = chisquaretest(
         normdist(xdata,
@@ -240,6 +460,29 @@ def chisquaretest(ydata, y, yerr, reducenum):
 #    return 1/reducenum*sum([(o-e)**2/o for o,e in zip(ydata,y) if o>0])
 
 
+def _Figure(GenerateImages, **kwargs):
+    '''
+    figure(**kwargs), or a RecordingFigure when GenerateImages is 'deferred'
+    '''
+    if GenerateImages == 'deferred':
+        return RecordingFigure(**kwargs)
+    return figure(**kwargs)
+
+
+def _ShowFigure(fig, plotspecs=None):
+    '''
+    show() for inline figures. Recorded figures are appended to plotspecs
+    or, when plotspecs is None, rendered straight away
+    '''
+    if isinstance(fig, RecordingFigure):
+        if plotspecs is None:
+            RenderFigure(fig.spec())
+        else:
+            plotspecs.append(fig.spec())
+    else:
+        show()
+
+
 def PrintValues(param, err, axis=None, roundto=4, size=10, offset=0):
     '''
     Prints fitted parameters from normfit in a pretty way (skips Amplitude)
@@ -272,17 +515,23 @@ def PrintValues(param, err, axis=None, roundto=4, size=10, offset=0):
             print(ParamNames[i], CurrentString)
 
 
-def FindFirstPhePeak(File, axis=None, SkipRows=4, verbose=0):
+@Instrumented('FindFirstPhePeak')
+def FindFirstPhePeak(File, axis=None, SkipRows=4, asmask=False, verbose=0):
     '''
     Loads F7 and returns the indices corresponding to the first peak only
+    File : filename or DataFrame from RunData
+    asmask : return a boolean mask over the rows of File instead of indices
     '''
-    df = read_csv(File, skiprows=SkipRows, sep=Seperator, index_col=0)
-    fdf = df[(df.Ampl > 1.5) & (df.Ampl < 2.5)]  # selects 2 only
+    df = LoadChannel(File, SkipRows)
+    Selected = ((df.Ampl > 1.5) & (df.Ampl < 2.5)).values  # selects 2 only
+    fdf = df[Selected]
+    Count('FindFirstPhePeak', 'eventsin', len(df))
+    Count('FindFirstPhePeak', 'eventsout', len(fdf))
 
     if len(fdf) == 0:
-        return []
+        return Selected if asmask else []
     if axis is not None:
-        X, Y = zip(*stats.itemfreq(df.Ampl))
+        X, Y = zip(*stats.itemfreq(df.Ampl.dropna()))
         X = array(X, dtype=float)
         Y = array(Y, dtype=float)
         Condition = (X > 1.5) & (X < 2.5)
@@ -290,18 +539,21 @@ def FindFirstPhePeak(File, axis=None, SkipRows=4, verbose=0):
         axis.bar(X[Condition], Y[Condition], color='r')
         axis.grid()
 
+    if asmask:
+        return Selected
     return list(fdf.index)
 
 
 def FindPhotoPeakEvents(File, binrange=(0.1, 1), fitrange=(0.3, 0.9), Bins=200,
-                        leftsigma=3, rightsigma=5, MinSamples=100, axis=None, SkipRows=4, verbose=0):
+                        leftsigma=3, rightsigma=5, MinSamples=100, axis=None, SkipRows=4, asmask=False, verbose=0):
         '''
         Finds peak in data and returns indices corresponding to
         left/right sigma from centroid of Normal distribution
         if matplotlib axis is passed then it will plot the data
+        asmask : return a boolean mask over the rows of File instead of indices
         '''
 
-        df = read_csv(File, skiprows=SkipRows, index_col=0, sep=Seperator)
+        df = LoadChannel(File, SkipRows)
 
         if verbose > 0:
             print("Length of data is", len(df))
@@ -310,11 +562,7 @@ def FindPhotoPeakEvents(File, binrange=(0.1, 1), fitrange=(0.3, 0.9), Bins=200,
             if verbose > 0:
                 print("Not enough data", len(df))
 
-        freq, edges = histogram(df.Ampl, bins=Bins, range=binrange)
-
-        edges = 0.5 * (edges[1:] + edges[:-1])
-        edges = edges[freq > 0]  # drops empty bins
-        freq = freq[freq > 0]
+        freq, edges, _ = Spectrum(binrange, Bins).add(df.Ampl.dropna()).nonzero()
 
         # Passing reduced datarange so the fitting algorithm is less confused
         #BinWidth = ptp(binrange) / Bins
@@ -354,15 +602,150 @@ def FindPhotoPeakEvents(File, binrange=(0.1, 1), fitrange=(0.3, 0.9), Bins=200,
             axis.set_ylim(0, MaxVal)
             PrintValues(param, err.diagonal(), axis)
 
-        fdf = df[(df.Ampl > MinValue) & (df.Ampl < MaxValue)]
-        return list(fdf.index), p1, chival
+        Condition = ((df.Ampl > MinValue) & (df.Ampl < MaxValue)).values
+        if asmask:
+            return Condition, p1, chival
+        return list(df[Condition].index), p1, chival
+
+
+def _PeakWindowFit(freq, edges, x, Step, p0=None, verbose=0):
+    '''
+    curve_fit of normdist to the bins within Step of the peak candidate x
+    returns param or None if the fit failed
+    '''
+    Condition = (edges > x - Step) & (edges < x + Step)
+    ydata = freq[Condition]
+    xdata = edges[Condition]
+
+    if len(xdata) < 3:
+        return None
+
+    if p0 is None:
+        try:
+            peakindex = ydata.searchsorted(mean(ydata))
+            guessloc = xdata[peakindex]  # peak location
+        except IndexError:
+            guessloc = xdata[len(xdata) // 2 - 1]  # middle of random data
+        p0 = [guessloc, 0.05, 1]
+
+    try:
+        param, err = curve_fit(normdist, xdata, ydata, p0=p0)
+    except RuntimeError:
+        if verbose > 0:
+            print("fit failed")
+        return None
+    return param
+
+
+def _BatchPeakWindowFits(freq, edges, peaks, Step):
+    '''
+    Fits every peak candidate window at once using Caruana's log-parabola
+    method (stacked weighted normal equations, one solve for all windows)
+    Windows the parabola can't describe (not concave, or a peak outside the
+    window, as a nearly flat Compton edge gives) fall back to curve_fit
+    returns param (loc, scale, amp) or None for each candidate
+    '''
+    if len(peaks) == 0:
+        return []
+
+    peaks = array(peaks, dtype=float)
+    freq = array(freq, dtype=float)
+    edges = array(edges, dtype=float)
+
+    Windows = (edges > peaks[:, None] - Step) & (edges < peaks[:, None] + Step) & (freq > 0)
+    Weights = Windows * freq ** 2
+    u = edges - peaks[:, None]  # centred on each candidate
+    Basis = stack((ones(u.shape), u, u ** 2), axis=-1)
+    Normal = einsum('kn,kni,knj->kij', Weights, Basis, Basis)
+    Target = einsum('kn,kni,n->ki', Weights, Basis, log(where(freq > 0, freq, 1)))
+
+    Valid = Windows.sum(axis=1) >= 3
+    Normal[~Valid] = eye(3)
+    try:
+        a, b, c = solve(Normal, Target[:, :, None])[:, :, 0].T
+    except LinAlgError:
+        return [_PeakWindowFit(freq, edges, x, Step) for x in peaks]
+
+    with errstate(divide='ignore', invalid='ignore', over='ignore'):
+        scale = sqrt(-0.5 / c)
+        loc = peaks - b / (2 * c)
+        amp = exp(a - b ** 2 / (4 * c)) * scale * sqrt(2 * pi)
+        Good = Valid & (c < 0) & isfinite(scale) & (scale > 0) & isfinite(amp) & \
+            (loc > peaks - Step) & (loc < peaks + Step)
+
+    return [array([l, sc, am]) if good else
+            _PeakWindowFit(freq, edges, x, Step) if valid else None
+            for x, l, sc, am, good, valid in zip(peaks, loc, scale, amp, Good, Valid)]
+
+
+@Instrumented('RankPhotoPeaks')
+def _RankPhotoPeaks(freq, edges, xmin, Step=0.05, batchfit=True, verbose=0):
+    '''
+    Finds and fits every peak candidate of an energy histogram, the highest
+    is the photopeak and the furthest right of the rest (above xmin) the
+    secondary peak
+
+    returns Photopeak, Secondpeak as (x, param) or None
+    '''
+    with Stage('peakdetect') as st:
+        MaxPeaks, MinPeaks = pkd.peakdetect_fast(freq, edges, lookahead=10)
+        st.count('candidates', len(MaxPeaks))
+
+    with Stage('peakfits') as st:
+        if batchfit:
+            Fits = _BatchPeakWindowFits(freq, edges, [x for x, y in MaxPeaks], Step)
+        else:
+            Fits = [_PeakWindowFit(freq, edges, x, Step, verbose=verbose) for x, y in MaxPeaks]
+        st.count('failures', sum(param is None for param in Fits))
+
+    maxpeak = 0  # resets for each series of peaks (biggest wins!)
+    secondarypeakloc = xmin
+    Photopeak = None
+    Secondpeak = None
+    for (x, y), param in zip(MaxPeaks, Fits):
+        if param is None:
+            continue
+        p1, p2, p3 = param
+        Y = normdist(p1, p1, p2, p3)  # max value
+        if verbose > 0:
+            print("Peak Height is", Y, "whereas maxpeak is", maxpeak)
+
+        if Y > maxpeak:  # for multiple peaks, we choose the highest
+            maxpeak = Y
+            Photopeak = x, param
+        elif p1 > secondarypeakloc:
+            secondarypeakloc = p1
+            Secondpeak = x, param
+    return Photopeak, Secondpeak
+
+
+def _RefinePeak(freq, edges, x, param, Step=0.05, batchfit=True, verbose=0):
+    '''
+    Polishes a batched peak fit with curve_fit (param is kept if that fails)
+    '''
+    if batchfit:
+        refined = _PeakWindowFit(freq, edges, x, Step, p0=param, verbose=verbose)
+        if refined is not None:
+            param = refined
+    return param
+
+
+def PhotopeakMask(Ampl, binrange, loc, scale, leftsigma=2, rightsigma=2):
+    '''
+    Boolean mask of the amplitudes within binrange and within leftsigma,
+    rightsigma standard deviations either side of a photopeak at loc
+    '''
+    xmin, xmax = binrange
+    return (Ampl > xmin) & (Ampl < xmax) & \
+        (Ampl > loc - leftsigma * scale) & (Ampl < loc + rightsigma * scale)
 
 
+@Instrumented('LocatePhotoPeaks')
 def LocatePhotoPeaks(
     afile, binrange=(0.1, 1), factor=8, MinValue=100, Step=0.05, leftsigma=2, rightsigma=2,
-        SkipRows=4, axis=None, verbose=0):
+        SkipRows=4, axis=None, asmask=False, batchfit=True, seed=None, verbose=0):
     '''
-    afile : filename (either 1 or 2)
+    afile : filename (either 1 or 2) or DataFrame from RunData
     binrange : events outside this range are ignored
     factor : assuming we're binning to a power of 2
     MinValue : minimum number of amplitude values to bother fitting to
@@ -371,14 +754,28 @@ def LocatePhotoPeaks(
     SkipRows : cropped guff out of data files
     GenerateImages : Should we generate images...yes
     axis : plot on this axis
+    asmask : return boolean masks over the rows of afile instead of indices
+    batchfit : rank the peak candidates with one batched log-parabola fit
+    rather than a curve_fit each. Either way only the chosen photopeak and
+    secondary peak are bootstrapped
+    seed : seed for the bootstrap random numbers (None, integer or RandomState)
     '''
 
     Bins = floor(ptp(binrange) * 2 ** factor)
     GenerateImages = axis is not None
 
     xmin, xmax = binrange
-    df = pds.read_csv(afile, skiprows=SkipRows, sep=";", index_col=0)
-    df = df[(df.Ampl > xmin) & (df.Ampl < xmax)]
+    fulldf = LoadChannel(afile, SkipRows)
+    Ampl = fulldf.Ampl.values
+    InRange = (Ampl > xmin) & (Ampl < xmax)
+    df = fulldf[InRange]
+    Count('LocatePhotoPeaks', 'eventsin', len(df))
+
+    def Selection(loc, scale):
+        Condition = PhotopeakMask(Ampl, binrange, loc, scale, leftsigma, rightsigma)
+        if asmask:
+            return Condition
+        return list(fulldf[Condition].index)
 
     if verbose > 0:
         print("Length of Data:", len(df))
@@ -388,11 +785,7 @@ def LocatePhotoPeaks(
             print("insufficient data!")
         return None, None
 
-    freq, edges = histogram(df.Ampl, bins=Bins, range=binrange)
-
-    edges = 0.5 * (edges[1:] + edges[:-1])
-    edges = edges[freq > 0]  # drops empty bins
-    freq = freq[freq > 0]
+    freq, edges, _ = Spectrum(binrange, Bins).add(df.Ampl).nonzero()  # drops empty bins
 
     if GenerateImages:
         axis.step(edges, freq, 'k-', where='mid')
@@ -400,61 +793,26 @@ def LocatePhotoPeaks(
         axis.set_xlabel("Energy")
         axis.set_ylabel("Frequency")
 
-    MaxPeaks, MinPeaks = pkd.peakdetect(freq, edges, lookahead=10)
-    maxpeak = 0  # resets for each series of peaks (biggest wins!)
-    secondarypeakloc = xmin
-    secondpeakfound = False
-    for x, y in MaxPeaks:
-        Condition = (edges > x - Step) & (edges < x + Step)
-        ydata = freq[Condition]
-        xdata = edges[Condition]
-
-        try:
-            peakindex = ydata.searchsorted(mean(ydata))
-            guessloc = xdata[peakindex]  # peak location
-        except IndexError:
-            guessloc = xdata[len(xdata) / 2 - 1]  # middle of random data
-
-        try:
-            param, err = curve_fit(
-                normdist, xdata, ydata, p0=[guessloc, 0.05, 1])
-        except RuntimeError:
-            if verbose > 0:
-                print("fit failed")
-            continue
-        # This is over complicated bollocks
-        #(16thSept)Nice
+    # phase one : fit every candidate (cheaply) and rank them
+    Photopeak, Secondpeak = _RankPhotoPeaks(freq, edges, xmin, Step, batchfit, verbose)
 
-        #(param,err),chival = normfit(xdata,ydata,yerr=sqrt(ydata),PeakGuess=guessloc,ScaleGuess=0.05,verbose=verbose)
-
-        if err is not float:
-            fdf = df[(df.Ampl > x - Step) & (df.Ampl < x + Step)]
-            p1, p2, p3 = param
-            errors = ScikitsBootstrap(fdf, loc=p1, scale=p2, verbose=verbose)
-            p1err, p2err, p3err = errors
-            Y = [normdist(p1, p1, p2, p3)]  # max value
-            if verbose > 0:
-                print("Peak Height is", max(Y), "whereas maxpeak is", maxpeak)
-
-            if max(Y) > maxpeak:  # for multiple peaks, we choose the highest
-                maxpeak = max(Y)
-                peakparam = param
-                peakerrors = errors
-            elif p1 > secondarypeakloc:
-                secondarypeakloc = p1
-                secondpeakparam = param
-                secondpeakerrors = errors
-                secondpeakfound = True
-
-    try:
-        p1, p2, p3 = peakparam
-        p1err, p2err, p3err = peakerrors
-        photopeakindices = list(
-            df[(df.Ampl > p1 - leftsigma * p2) & (df.Ampl < p1 + rightsigma * p2)].index)
-    except NameError:
+    if Photopeak is None:
         print("photopeak fit failed")
         return None, None
 
+    # phase two : bootstrap errors for the chosen peaks only
+    def Errors(x, param):
+        param = _RefinePeak(freq, edges, x, param, Step, batchfit, verbose)
+        fdf = df[(df.Ampl > x - Step) & (df.Ampl < x + Step)]
+        p1, p2, p3 = param
+        return param, ScikitsBootstrap(fdf, loc=p1, scale=p2, seed=seed, verbose=verbose)
+
+    peakparam, peakerrors = Errors(*Photopeak)
+    p1, p2, p3 = peakparam
+    p1err, p2err, p3err = peakerrors
+    photopeakindices = Selection(p1, p2)
+    Count('LocatePhotoPeaks', 'eventsout', photopeakindices.sum() if asmask else len(photopeakindices))
+
     if verbose > 0:
         print("photopeak location :", p1, "+/-", p1err)
 
@@ -465,11 +823,12 @@ def LocatePhotoPeaks(
         axis.plot(X, Y, '-')
         PrintValues(peakparam, peakerrors, axis, size=10)
         axis.set_xlim(xmin, xmax)
+    secondpeakfound = Secondpeak is not None
     if secondpeakfound:
+        secondpeakparam, secondpeakerrors = Errors(*Secondpeak)
         s1, s2, s3 = secondpeakparam
         s1err, s2err, s3err = secondpeakerrors
-        secondpeakindices = list(
-            df[(df.Ampl > s1 - leftsigma * s2) & (df.Ampl < s1 + rightsigma * s2)].index)
+        secondpeakindices = Selection(s1, s2)
 
         if verbose > 0:
             print("Secondary photopeak location :", s1, "+/-", s1err)
@@ -488,7 +847,7 @@ def LocatePhotoPeaks(
     else:
         secondpeakparam = [0, 0, 0]
         secondpeakerrors = [0, 0, 0]
-        secondpeakindices = []
+        secondpeakindices = InRange & False if asmask else []
 
     return (
         (photopeakindices, peakparam, peakerrors), (
@@ -496,6 +855,22 @@ def LocatePhotoPeaks(
     )
 
 
+def _CombineMasks(SelectIndices, One, Two, TwoSecond, Three, Four):
+    '''
+    Event selection from the left photopeak (One), right photopeak (Two) or
+    secondary peak (TwoSecond) and single edge (Three, Four) masks
+    returns None for an unknown SelectIndices
+    '''
+    if SelectIndices == 0:
+        return One & Two & Three & Four
+    elif SelectIndices == 1:
+        return One & TwoSecond & Three & Four
+    elif SelectIndices == 2:
+        return One & (Two | TwoSecond) & Three & Four
+    return None
+
+
+@Instrumented('DelayPeakFitting')
 def DelayPeakFitting(filenames, uniquename, **kwargs):
     '''
     Fits Gaussian distribution to delay distribution after removing Left,Right Energy SiPM and multiple edges
@@ -507,6 +882,8 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
     workingon ('doi') : experiment keyword
     SkipRows (4) : When files aren't combined we have a series of parameters left
     GenerateImages (False) : Plots and saves figures to Global variable ImageSaveLocation
+    'deferred' records the figures as plot specs rather than drawing them
+    plotspecs (None) : list deferred plot specs are appended to (rendered at once if None)
     ImageKey (""): additional text string to add when saving figures
     timerange (-1000,1000): time range for plotting over
     MinSamples (100) : Minimum number of datapoints to bother fitting to
@@ -515,6 +892,15 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
     SelectIndices : Determines whether we should select actively from secondary photopeak
     leftpherange : Range to search for photopeak in left scintillator detector energy spectrum
     rightpherange : Range to search for photopeak in Right scintillator detector energy spectrum
+    seed (None) : seed for the bootstrap random numbers
+    empiricalruns (500) : number of resamples for the empirical bootstrap
+    fitbackend ('curvefit') : normfit backend for the CTR fit, 'fast' avoids curve_fit
+    memo (False) : reuse photopeak fits and edge masks from a MemoCache (True uses
+    SharedMemo()) keyed by the run's files and the stage parameters. Ignored when
+    GenerateImages is set as cached stages don't draw
+    chunksize (None) : stream the run chunksize events at a time through
+    StreamedSelection instead of loading it (for runs larger than memory,
+    the energy and edge figure isn't drawn)
     verbose : verbosity variable (lots of potential printing WARNING!)
     '''
 
@@ -522,6 +908,7 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
     workingon = kwargs.get('workingon', 'doi')
     SkipRows = kwargs.get('SkipRows', 4)
     GenerateImages = kwargs.get('GenerateImages', False)
+    plotspecs = kwargs.get('plotspecs', None)
     ImageKey = kwargs.get('ImageKey', "")
     timerange = kwargs.get('timerange', (-1000, 1000))
     MinSamples = kwargs.get('MinSamples', 100)
@@ -530,6 +917,11 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
     SelectIndices = kwargs.get('SelectIndices', 0)
     LeftPheRange = kwargs.get('leftpherange', (0.4, 0.8))
     RightPheRange = kwargs.get('rightpherange', (0.2, 0.8))
+    seed = kwargs.get('seed', None)
+    EmpiricalRuns = kwargs.get('empiricalruns', 500)
+    FitBackend = kwargs.get('fitbackend', 'curvefit')
+    memo = kwargs.get('memo', False)
+    chunksize = kwargs.get('chunksize', None)
     verbose = kwargs.get('verbose', 0)
 
     A, B = uniquename.split('vs')
@@ -558,152 +950,179 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
             elif crystallength == 2396:
                 crystallength == 20
 
-    if GenerateImages:
-        fig = figure(figsize=(12, 12))
-        ax1 = fig.add_subplot(221)
-        ax2 = fig.add_subplot(222)
-        ax3 = fig.add_subplot(223)
-        ax4 = fig.add_subplot(224)
-        ax1.set_title("Left Maxima")
-        ax2.set_title("Right Maxima")
-        ax3.set_title("Left Edges")
-        ax4.set_title("Right Edges")
+    if chunksize is not None:
+        # out of core : only the selected delays are ever held in memory
+        Streamed = StreamedSelection(filenames, LeftPheRange, RightPheRange, SelectIndices,
+                                     SkipRows=SkipRows, chunksize=chunksize, seed=seed,
+                                     verbose=verbose)
+        if Streamed is None:
+            return 1
+        fdf, (LeftPeakParam, LeftPeakError), (RightPeakParam, RightPeakError), (
+            RightSecondPeakParam, RightSecondPeakError) = Streamed
     else:
-        ax1 = None
-        ax2 = None
-        ax3 = None
-        ax4 = None
-
-    if verbose > 1:
-        for j in range(1, 6) + [7, 8]:
-            print(j, ":", filenames[j])
-
-    LeftFirstPeak, LeftSecondpeak = LocatePhotoPeaks(
-        filenames[1], binrange=LeftPheRange, SkipRows=SkipRows, axis=ax1, verbose=verbose)
-    if LeftFirstPeak is None:
         if GenerateImages:
-            fig.clear()  # scrubs plot
-        if verbose > 0:
-            print("Left photopeak won't fit")
-        return 1
-
-    IndicesOne, LeftPeakParam, LeftPeakError = LeftFirstPeak
-    # ignoring any secondary peaks in reference photodetector
+            fig = _Figure(GenerateImages, figsize=(12, 12))
+            ax1 = fig.add_subplot(221)
+            ax2 = fig.add_subplot(222)
+            ax3 = fig.add_subplot(223)
+            ax4 = fig.add_subplot(224)
+            ax1.set_title("Left Maxima")
+            ax2.set_title("Right Maxima")
+            ax3.set_title("Left Edges")
+            ax4.set_title("Right Edges")
+        else:
+            ax1 = None
+            ax2 = None
+            ax3 = None
+            ax4 = None
+
+        if verbose > 1:
+            for j in sorted(FileNumDict):
+                print(j, ":", filenames[j])
+
+        with Stage('RunData'):
+            run = RunData(filenames, SkipRows=SkipRows, verbose=verbose)
+
+        if memo is True:
+            memo = SharedMemo()
+        if isinstance(memo, MemoCache) and not GenerateImages:  # an empty MemoCache is falsy
+            # masks are over the aligned event axis so depend on every channel file
+            fingerprint = (RunFingerprint(filenames), SkipRows)
+
+            def Photopeaks(j, binrange, axis):
+                return memo('LocatePhotoPeaks', fingerprint + (j,), LocatePhotoPeaks,
+                            run.channel(j, aligned=True), binrange=binrange, asmask=True,
+                            seed=seed, verbose=verbose)
+
+            def Edges(j, axis):
+                return memo('FindFirstPhePeak', fingerprint + (j,), FindFirstPhePeak,
+                            run.channel(j, aligned=True), asmask=True, verbose=verbose)
+        else:
+            def Photopeaks(j, binrange, axis):
+                return LocatePhotoPeaks(run.channel(j, aligned=True), binrange=binrange,
+                                        axis=axis, asmask=True, seed=seed, verbose=verbose)
+
+            def Edges(j, axis):
+                return FindFirstPhePeak(run.channel(j, aligned=True), axis=axis,
+                                        asmask=True, verbose=verbose)
+
+        LeftFirstPeak, LeftSecondpeak = Photopeaks(1, LeftPheRange, ax1)
+        if LeftFirstPeak is None:
+            if GenerateImages:
+                fig.clear()  # scrubs plot
+            if verbose > 0:
+                print("Left photopeak won't fit")
+            return 1
 
-    if verbose > 0:
-        p1, p2, p3 = LeftPeakParam
-        p1err, p2err, p3err = LeftPeakError
-        print("Left Peak Position", p1, "+/-", p1err)
+        IndicesOne, LeftPeakParam, LeftPeakError = LeftFirstPeak
+        # ignoring any secondary peaks in reference photodetector
 
-    RightFirstPeak, RightSecondpeak = LocatePhotoPeaks(
-        filenames[2], binrange=RightPheRange, SkipRows=SkipRows, axis=ax2, verbose=verbose)
-    if RightFirstPeak is None:
-        if GenerateImages:
-            fig.clear()  # scrubs plot
         if verbose > 0:
-            print("Right photopeak won't fit")
-        return 1
+            p1, p2, p3 = LeftPeakParam
+            p1err, p2err, p3err = LeftPeakError
+            print("Left Peak Position", p1, "+/-", p1err)
+
+        RightFirstPeak, RightSecondpeak = Photopeaks(2, RightPheRange, ax2)
+        if RightFirstPeak is None:
+            if GenerateImages:
+                fig.clear()  # scrubs plot
+            if verbose > 0:
+                print("Right photopeak won't fit")
+            return 1
 
-    IndicesTwo, RightPeakParam, RightPeakError = RightFirstPeak
-    if verbose > 0:
-        p1, p2, p3 = LeftPeakParam
-        p1err, p2err, p3err = LeftPeakError
-        print("Right Peak Position", p1, "+/-", p1err)
+        IndicesTwo, RightPeakParam, RightPeakError = RightFirstPeak
+        if verbose > 0:
+            p1, p2, p3 = LeftPeakParam
+            p1err, p2err, p3err = LeftPeakError
+            print("Right Peak Position", p1, "+/-", p1err)
 
-    IndicesTwoSecond, RightSecondPeakParam, RightSecondPeakError = RightSecondpeak
+        IndicesTwoSecond, RightSecondPeakParam, RightSecondPeakError = RightSecondpeak
 
-    if verbose > 0:
-        print("Calculating Edges")
-
-    IndicesThree = FindFirstPhePeak(
-        filenames[7],
-        axis=ax3,
-        SkipRows=SkipRows,
-        verbose=verbose)
-    IndicesFour = FindFirstPhePeak(
-        filenames[8],
-        axis=ax4,
-        SkipRows=SkipRows,
-        verbose=verbose)
+        if verbose > 0:
+            print("Calculating Edges")
 
-    if GenerateImages:
-        fig.tight_layout()
-        for Ext in Extensions:
-            fig.savefig(
-                ImageSaveLocation +
-                '/' +
-                Ext +
-                '/' +
-                SampleNames +
-                '_' +
-                uniquename +
-                '_' +
-                'IndexData' +
-                '.' +
-                Ext)
-        show()
+        IndicesThree = Edges(7, ax3)
+        IndicesFour = Edges(8, ax4)
 
-    if SelectIndices == 0:
-        Indices = list(set(IndicesOne) & set(
-            IndicesTwo) & set(IndicesThree) & set(IndicesFour))
-    elif SelectIndices == 1:
-        Indices = list(set(IndicesOne) & set(
-            IndicesTwoSecond) & set(IndicesThree) & set(IndicesFour))
-    elif SelectIndices == 2:
-        Indices = list(set(IndicesOne) & (set(IndicesTwo) | set(IndicesTwoSecond))
-                       & set(IndicesThree) & set(IndicesFour))
-    else:
-        print("Only three choices available matey jim!")
-        return 1
+        if GenerateImages:
+            with Stage('savefig'):
+                fig.tight_layout()
+                for Ext in Extensions:
+                    fig.savefig(
+                        ImageSaveLocation +
+                        '/' +
+                        Ext +
+                        '/' +
+                        SampleNames +
+                        '_' +
+                        uniquename +
+                        '_' +
+                        'IndexData' +
+                        '.' +
+                        Ext)
+            _ShowFigure(fig, plotspecs)
+
+        with Stage('selection') as st:
+            # every Indices* is a boolean mask over the shared event axis of run
+            Indices = _CombineMasks(SelectIndices, IndicesOne, IndicesTwo, IndicesTwoSecond,
+                                    IndicesThree, IndicesFour)
+            if Indices is None:
+                print("Only three choices available matey jim!")
+                return 1
+
+            df = run.channel(3, aligned=True)
+            Indices &= df.Ampl.notnull().values  # event must have a delay too
+            st.count('eventsin', len(df))
+            st.count('eventsout', Indices.sum())
 
-    if verbose > 0:
-        print("Length of Indices is", len(Indices))
+        if verbose > 0:
+            print("Length of Indices is", Indices.sum())
 
-    df = read_csv(filenames[3], skiprows=SkipRows, index_col=0, sep=Seperator)
-    df.Ampl *= 1e12  # time in ps
-    fdf = df[df.index.isin(Indices)]  # selects matching data only
+        df.Ampl *= 1e12  # time in ps
+        fdf = df[Indices]  # selects matching data only
 
     if len(fdf) < MinSamples:
         if verbose > 0:
             print("Insufficient number of samples", len(fdf))
         return 1
 
-    Frequency, Values = histogram(
-        fdf.Ampl, range=timerange, bins=ptp(timerange) / dt)
-    Values = 0.5 * (Values[1:] + Values[:-1])
-
-    Values = Values[Frequency > 0]
-    Frequency = Frequency[Frequency > 0]
+    Frequency, Values, _ = Spectrum(timerange, ptp(timerange) / dt).add(fdf.Ampl).nonzero()
 
     if verbose > 0:
         print("Number of samples is", len(fdf))
 
     xmin, xmax = timerange
     (param, err), chival = normfit(Values, Frequency, yerr=sqrt(Frequency),
-                                   ScaleGuess=100, PeakGuess=100, failedfitmax=100, verbose=verbose)  # fit to CTR peak
+                                   ScaleGuess=100, PeakGuess=100, failedfitmax=100,
+                                   backend=FitBackend, verbose=verbose)  # fit to CTR peak
 
     try:
         p1, p2, p3 = param
     except TypeError:
-        fig = figure()
-        ax = fig.add_subplot(111)
-        ax.step(Values, Frequency, 'k-')
-        show()
+        if GenerateImages:
+            fig = _Figure(GenerateImages)
+            ax = fig.add_subplot(111)
+            ax.step(Values, Frequency, 'k-')
+            _ShowFigure(fig, plotspecs)
         assert 1 == 2
 
     if errortype == 'lsq':  # error generated by curve_fit()
         locerr, scaleerr, amperr = err.diagonal()
     elif errortype == 'parametric':
-        locerr, scaleerr = ParametricBootstrap(p1, p2, len(fdf.Ampl))
+        (LocLower, LocUpper), (ScaleLower, ScaleUpper) = ParametricBootstrap(
+            p1, p2, len(fdf.Ampl), interval='bca', seed=seed, verbose=verbose)
+        locerr = (LocUpper - p1) / 1.96
+        scaleerr = (ScaleUpper - p2) / 1.96
         amperr = 0
     elif errortype == 'empirical':
-        (param, err), chival = EmpiricalBootstrap(fdf.Ampl, p2,
-                                                  filenames[3], GenerateImages=GenerateImages, ImageKey=ImageKey, verbose=verbose)
+        (param, err), chival = EmpiricalBootstrap(fdf.Ampl, p2, filenames[3], NRuns=EmpiricalRuns,
+                                                  timerange=timerange, dt=dt, GenerateImages=GenerateImages, ImageKey=ImageKey,
+                                                  plotspecs=plotspecs, seed=seed, verbose=verbose)
         locerr, scaleerr, amperr = param
     elif errortype == 'scikits':
             #(fdf,loc=0,sigma=100,leftsigma=2,rightsigma=2,verbose=0)
         locerr, scaleerr, amperr = ScikitsBootstrap(
-            fdf, loc=p1, scale=p2, verbose=verbose)
+            fdf, loc=p1, scale=p2, seed=seed, verbose=verbose)
         #fRawData = fdf.Ampl[abs(fdf.Ampl) < 500]
         #CILower,CIUpper = btp.ci(fRawData,std)
         #scaleerr = (CIUpper-std(fRawData))/1.96
@@ -716,7 +1135,7 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
         assert 1 == 2, "Error!"
 
     if GenerateImages:
-        fig = figure()
+        fig = _Figure(GenerateImages)
         ax = fig.add_subplot(111)
         ax.errorbar(Values, Frequency, yerr=sqrt(Frequency), fmt='r.')
         X = linspace(xmin, xmax, 1000)
@@ -732,20 +1151,21 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
         PrintValues(param, [locerr, scaleerr, amperr], ax)
         fig.tight_layout()
 
-        for Ext in Extensions:
-            fig.savefig(
-                ImageSaveLocation +
-                '/' +
-                Ext +
-                '/' +
-                SampleNames +
-                '_' +
-                uniquename +
-                '_' +
-                'CTR' +
-                '.' +
-                Ext)
-        show()
+        with Stage('savefig'):
+            for Ext in Extensions:
+                fig.savefig(
+                    ImageSaveLocation +
+                    '/' +
+                    Ext +
+                    '/' +
+                    SampleNames +
+                    '_' +
+                    uniquename +
+                    '_' +
+                    'CTR' +
+                    '.' +
+                    Ext)
+        _ShowFigure(fig, plotspecs)
 
     DataDict = {
         "uniquename": uniquename, "location": p1, "locationerr": locerr, "scale":
@@ -765,7 +1185,209 @@ def DelayPeakFitting(filenames, uniquename, **kwargs):
     return DataDict
 
 
-def FindDelayData(filenames, uniquename, outputdir, verbose=0):
+@Instrumented('StreamedSelection')
+def StreamedSelection(filenames, leftpherange=(0.4, 0.8), rightpherange=(0.2, 0.8),
+                      SelectIndices=0, SkipRows=4, chunksize=None, factor=8, Step=0.05,
+                      MinValue=100, batchfit=True, seed=None, verbose=0):
+    '''
+    DelayPeakFitting's event selection in two streamed passes, memory is
+    bounded by the chunk size and the selected events rather than the run
+
+    pass one : the left and right energy spectra are histogrammed chunk by
+    chunk (Spectrum) and the photopeaks located from the histograms alone
+    (as LocatePhotoPeaks, with factor, Step, MinValue and batchfit)
+    pass two : StreamRun aligns the energy, delay and edge channels chunk by
+    chunk, the photopeak and edge cuts are applied per chunk and only the
+    selected delays and the energies in each peak's fit window (for the
+    bootstrap errors) are kept
+    seed : seed for the photopeak bootstraps
+
+    returns DataFrame of the selected delays (ps, Ampl column) and
+    (param, errors) of the left photopeak, right photopeak and right
+    secondary peak, or None if a photopeak can't be found
+    '''
+    if SelectIndices not in (0, 1, 2):
+        raise KeyError("Unknown SelectIndices " + str(SelectIndices))
+    if chunksize is None:
+        chunksize = streaming.StreamChunkSize
+
+    Peaks = {}
+    with Stage('pass1'):
+        for j, binrange in [(1, leftpherange), (2, rightpherange)]:
+            xmin, xmax = binrange
+            spectrum = Spectrum(binrange, floor(ptp(binrange) * 2 ** factor))
+            for chunk in read_csv(filenames[j], skiprows=SkipRows, sep=Seperator,
+                                  index_col=0, chunksize=chunksize):
+                Ampl = chunk.Ampl.values
+                spectrum.add(Ampl[(Ampl > xmin) & (Ampl < xmax)])
+            if len(spectrum) < MinValue:
+                if verbose > 0:
+                    print("insufficient data!")
+                return None
+
+            freq, edges, _ = spectrum.nonzero()
+            Photopeak, Secondpeak = _RankPhotoPeaks(freq, edges, xmin, Step, batchfit, verbose)
+            if Photopeak is None:
+                print("photopeak fit failed")
+                return None
+            Peaks[j] = [None if peak is None else
+                        (peak[0], _RefinePeak(freq, edges, peak[0], peak[1], Step, batchfit, verbose))
+                        for peak in [Photopeak, Secondpeak]]
+
+    # left photopeak, right photopeak and right secondary peak (may be None)
+    Chosen = [(1, leftpherange, Peaks[1][0]), (2, rightpherange, Peaks[2][0]),
+              (2, rightpherange, Peaks[2][1])]
+
+    Delays = []
+    Windows = [[] for peak in Chosen]  # energies about each peak for the bootstrap
+    with Stage('pass2') as st:
+        for chunk in StreamRun(filenames, [1, 2, 3, 7, 8], SkipRows=SkipRows,
+                               chunksize=chunksize, sep=Seperator):
+            Energies = {1: chunk[1].values, 2: chunk[2].values}
+            Delay, LeftEdges, RightEdges = [chunk[j].values for j in [3, 7, 8]]
+
+            Masks = []
+            for i, (j, binrange, peak) in enumerate(Chosen):
+                Ampl = Energies[j]
+                if peak is None:  # selects nothing
+                    Masks.append(zeros(len(Ampl), dtype=bool))
+                    continue
+                (x, param), (xmin, xmax) = peak, binrange
+                Masks.append(PhotopeakMask(Ampl, binrange, param[0], param[1]))
+                Windows[i].append(Ampl[(Ampl > xmin) & (Ampl < xmax) &
+                                       (Ampl > x - Step) & (Ampl < x + Step)])
+
+            Indices = _CombineMasks(SelectIndices, Masks[0], Masks[1], Masks[2],
+                                    (LeftEdges > 1.5) & (LeftEdges < 2.5),  # selects 2 only
+                                    (RightEdges > 1.5) & (RightEdges < 2.5))
+            Indices &= ~isnan(Delay)  # event must have a delay too
+            Delays.append(Delay[Indices] * 1e12)  # time in ps
+            st.count('eventsin', len(chunk))
+            st.count('eventsout', Indices.sum())
+
+    Results = []
+    for (j, binrange, peak), Window in zip(Chosen, Windows):
+        if peak is None:
+            Results.append(([0, 0, 0], [0, 0, 0]))
+            continue
+        x, param = peak
+        fdf = DataFrame({'Ampl': concatenate(Window)})
+        Results.append((param, ScikitsBootstrap(fdf, loc=param[0], scale=param[1],
+                                                seed=seed, verbose=verbose)))
+
+    fdf = DataFrame({'Ampl': concatenate(Delays) if Delays else array([])})
+    if verbose > 0:
+        print("Length of Indices is", len(fdf))
+    return [fdf] + Results
+
+
+@Instrumented('SweepDelayFitting')
+def SweepDelayFitting(filenames, uniquename, grid=None, SkipRows=4, SelectIndices=0,
+                      MinSamples=100, fitbackend='curvefit', verbose=0):
+    '''
+    Fits the delay distribution of one run over a grid of analysis parameters
+
+    filenames : Dict of filenames generated by FetchFile
+    uniquename : unique name describing this set of parameters
+    grid : dict of parameter : list of values to try, any of
+        leftpherange ([(0.4, 0.8)]), rightpherange ([(0.2, 0.8)]),
+        leftsigma ([2]), rightsigma ([2]), timerange ([(-1000, 1000)]), dt ([25])
+    SelectIndices, MinSamples, fitbackend : as DelayPeakFitting
+
+    The run is loaded once. Photopeaks are located once per pherange (the fit
+    doesn't depend on the sigmas) and each event selection is shared by every
+    timerange and dt
+
+    returns tidy DataFrame with a row per grid point : the parameters,
+    numofsamples, location, scale, amplitude, their errors (square root of the
+    fit covariance) and chisquared. Failed points are NaN. GenerateCTR takes
+    the scale columns as they are
+    '''
+    if SelectIndices not in (0, 1, 2):
+        raise KeyError("Unknown SelectIndices " + str(SelectIndices))
+
+    Grid = {'leftpherange': [(0.4, 0.8)], 'rightpherange': [(0.2, 0.8)],
+            'leftsigma': [2], 'rightsigma': [2], 'timerange': [(-1000, 1000)], 'dt': [25]}
+    Grid.update(grid or {})
+    for key in ['leftpherange', 'rightpherange', 'timerange']:  # ranges are used as dict keys
+        Grid[key] = [tuple(arange) for arange in Grid[key]]
+    Keys = ['leftpherange', 'rightpherange', 'leftsigma', 'rightsigma', 'timerange', 'dt']
+
+    with Stage('RunData'):
+        run = RunData(filenames, SkipRows=SkipRows, verbose=verbose)
+    Left = run.channel(1, aligned=True).Ampl.values
+    Right = run.channel(2, aligned=True).Ampl.values
+    Delay = run.channel(3, aligned=True).Ampl.values * 1e12  # time in ps
+
+    # independent of the grid
+    Edges = FindFirstPhePeak(run.channel(7, aligned=True), asmask=True) & \
+        FindFirstPhePeak(run.channel(8, aligned=True), asmask=True) & ~isnan(Delay)
+
+    Photopeaks = {}  # (channel, pherange) : (first peak param, second peak param) or None
+
+    def Peaks(j, pherange, factor=8, MinValue=100, Step=0.05):
+        # as LocatePhotoPeaks but without the bootstrap errors, which the sweep doesn't use
+        if (j, pherange) not in Photopeaks:
+            Photopeaks[j, pherange] = None
+            xmin, xmax = pherange
+            Ampl = run.channel(j, aligned=True).Ampl.values
+            Ampl = Ampl[(Ampl > xmin) & (Ampl < xmax)]
+            if len(Ampl) >= MinValue:
+                freq, edges, _ = Spectrum(pherange, floor(ptp(pherange) * 2 ** factor)).add(Ampl).nonzero()
+                Photopeak, Secondpeak = _RankPhotoPeaks(freq, edges, xmin, Step, verbose=verbose)
+                if Photopeak is not None:
+                    Photopeaks[j, pherange] = tuple(
+                        [0, 0, 0] if peak is None else  # selects nothing
+                        _RefinePeak(freq, edges, peak[0], peak[1], Step, verbose=verbose)
+                        for peak in [Photopeak, Secondpeak])
+        return Photopeaks[j, pherange]
+
+    Rows = []
+    Selections = {}
+    for Point in itertools.product(*[Grid[key] for key in Keys]):
+        leftpherange, rightpherange, leftsigma, rightsigma, timerange, dt = Point
+        Row = dict(zip(Keys, Point), uniquename=uniquename)
+        Rows.append(Row)
+
+        selkey = Point[:4]
+        if selkey not in Selections:
+            LeftPeaks, RightPeaks = Peaks(1, leftpherange), Peaks(2, rightpherange)
+            if LeftPeaks is None or RightPeaks is None:
+                Selections[selkey] = None
+            else:
+                Masks = [PhotopeakMask(Ampl, pherange, param[0], param[1], leftsigma, rightsigma)
+                         for Ampl, pherange, param in [(Left, leftpherange, LeftPeaks[0]),
+                                                       (Right, rightpherange, RightPeaks[0]),
+                                                       (Right, rightpherange, RightPeaks[1])]]
+                Indices = _CombineMasks(SelectIndices, Masks[0], Masks[1], Masks[2], Edges, Edges)
+                Selections[selkey] = Delay[Indices]
+        Delays = Selections[selkey]
+        if Delays is None:
+            continue
+
+        Row['numofsamples'] = len(Delays)
+        if len(Delays) < MinSamples:
+            continue
+
+        Frequency, Values, _ = Spectrum(timerange, ptp(timerange) / dt).add(Delays).nonzero()
+        (param, err), chival = normfit(Values, Frequency, yerr=sqrt(Frequency),
+                                       ScaleGuess=100, PeakGuess=100, failedfitmax=100,
+                                       backend=fitbackend, verbose=verbose)
+        if param is None:
+            continue
+        Row.update(zip(['location', 'scale', 'amplitude'], param))
+        Row.update(zip(['locationerr', 'scaleerr', 'amplitudeerr'], sqrt(abs(err.diagonal()))))
+        Row['chisquared'] = chival
+
+        if verbose > 0:
+            print(Point, ":", Row['scale'], "ps")
+
+    Columns = ['uniquename'] + Keys + ['numofsamples', 'location', 'locationerr', 'scale',
+                                       'scaleerr', 'amplitude', 'amplitudeerr', 'chisquared']
+    return pds.DataFrame(Rows, columns=Columns)
+
+
+def FindDelayData(filenames, uniquename, outputdir, SkipRows=4, verbose=0):
     '''
     Fits Gaussian distribution to delay distribution after removing Left,Right Energy SiPM and multiple edges
 
@@ -777,24 +1399,25 @@ def FindDelayData(filenames, uniquename, outputdir, verbose=0):
     if verbose > 0:
         print("--", uniquename, "--")
 
+    run = RunData(filenames, SkipRows=SkipRows, verbose=verbose)
+
     IndicesOne, LeftPhotopeakLoc, FitValLeft = FindPhotoPeakEvents(
-        filenames[1], fitrange=Leftfitregion, verbose=verbose)
+        run.channel(1, aligned=True), fitrange=Leftfitregion, asmask=True, verbose=verbose)
     IndicesTwo, RightPhotopeakLoc, FitValRight = FindPhotoPeakEvents(
-        filenames[2], fitrange=Rightfitregion, verbose=verbose)
+        run.channel(2, aligned=True), fitrange=Rightfitregion, asmask=True, verbose=verbose)
 
     if (FitValLeft is None) or (FitValRight is None):
         print("Fit Failed")
         return None
 
-    IndicesThree = FindFirstPhePeak(filenames[7], verbose=verbose)
-    IndicesFour = FindFirstPhePeak(filenames[8], verbose=verbose)
+    IndicesThree = FindFirstPhePeak(run.channel(7, aligned=True), asmask=True, verbose=verbose)
+    IndicesFour = FindFirstPhePeak(run.channel(8, aligned=True), asmask=True, verbose=verbose)
 
-    Indices = list(set(IndicesOne) & set(IndicesTwo)
-                   & set(IndicesThree) & set(IndicesFour))
+    df = run.channel(3, aligned=True)
+    Indices = IndicesOne & IndicesTwo & IndicesThree & IndicesFour & df.Ampl.notnull().values
 
-    df = read_csv(filenames[3], skiprows=SkipRows, sep=Seperator, index_col=0)
     df.Ampl *= 1e12  # time in ps
-    fdf = df[df.index.isin(Indices)]  # selects matching data only
+    fdf = df[Indices]  # selects matching data only
 
     rootloc, fn = os.path.split(filenames[3])
     ctrloc = outputdir + '/ctrdata'
@@ -812,12 +1435,8 @@ def FitToDelayData(
     Calculates error using bootstrap
     '''
 
-    freq, binedges = histogram(
-        DelayValues, bins=2 * timerange / 25 + 1, range=(-timerange, timerange))
-    binedges = 0.5 * (binedges[1:] + binedges[:-1])
-
-    binedges = binedges[freq > 0]
-    freq = freq[freq > 0]
+    freq, binedges, _ = Spectrum(
+        (-timerange, timerange), 2 * timerange / 25 + 1).add(DelayValues).nonzero()
 
     (param, err), chival = normfit(binedges, freq, yerr=sqrt(freq),
                                    ScaleGuess=100, verbose=verbose)  # fit to CTR peak
@@ -825,11 +1444,9 @@ def FitToDelayData(
 
     DelayValues = array(DelayValues)
     fRawData = DelayValues[abs(DelayValues) < 500]
-    CILower, CIUpper = btp.ci(fRawData, std)
-    scaleerr = (CIUpper - std(fRawData)) / 1.96
-
-    CILower, CIUpper = btp.ci(fRawData, mean)
-    locerr = (CIUpper - mean(fRawData)) / 1.96
+    (MeanLower, MeanUpper), (StdLower, StdUpper) = BCaMeanStd(fRawData)
+    scaleerr = (StdUpper - std(fRawData)) / 1.96
+    locerr = (MeanUpper - mean(fRawData)) / 1.96
     ##amperr = p3  # currently ignored
 
     p1err, p2err, p3err = err.diagonal()
@@ -837,13 +1454,18 @@ def FitToDelayData(
     return param, (locerr, scaleerr, p3err)
 
 
-def ScikitsBootstrap(fdf, loc=0, scale=100,
-                     leftsigma=5, rightsigma=5, minsamples=100, verbose=1):
+@Instrumented('ScikitsBootstrap')
+def ScikitsBootstrap(fdf, loc=0, scale=100, leftsigma=5, rightsigma=5,
+                     minsamples=100, nsamples=None, seed=None, verbose=1):
     '''
     parameters from fit of Gaussian are used to clip total range of data
     from this a BCA bootstrap of the error in the loc and scale are found
     by the MLE estimates (std and mean respectively) --> This will ONLY
     work if the data given IS Gaussian
+
+    Both come from a single pass of bootstrap.BCaMeanStd
+    nsamples : number of resamples (bootstrap.BootstrapSamples)
+    seed : None, integer or RandomState
     '''
 
 #    fRawData = fdf.Ampl[abs(fdf.Ampl) < 1000]
@@ -855,22 +1477,29 @@ def ScikitsBootstrap(fdf, loc=0, scale=100,
         if verbose > 0:
             print("insufficient data")
         return (1e12, 1e12, 1e12)
-    CILower, CIUpper = btp.ci(fRawData, std)
-    scaleerr = (CIUpper - std(fRawData)) / 1.96
-
-    CILower, CIUpper = btp.ci(fRawData, mean)
-    locerr = (CIUpper - mean(fRawData)) / 1.96
+    (MeanLower, MeanUpper), (StdLower, StdUpper) = BCaMeanStd(
+        fRawData, nsamples=nsamples, seed=seed)
+    scaleerr = (StdUpper - std(fRawData)) / 1.96
+    locerr = (MeanUpper - mean(fRawData)) / 1.96
     amperr = 0  # currently ignored
     return (locerr, scaleerr, amperr)
 
 
-def ParametricBootstrap(loc, scale, N, Runs=500, verbose=0):
-    dist = stats.norm(loc=loc, scale=scale)
+@Instrumented('ParametricBootstrap')
+def ParametricBootstrap(loc, scale, N, Runs=500, interval=None, alpha=0.05,
+                        chunksize=None, seed=None, verbose=0):
+    '''
+    Refits Runs samples of size N drawn from Normal(loc, scale)
+    (see bootstrap.ParametricNormal)
 
-    RandomSamples = dist.rvs(N * Runs)
-    estloc, estscale = zip(*[stats.norm.fit(nsam)
-                           for nsam in RandomSamples[::Runs]])
-    return mean(estloc), mean(estscale)
+    interval : None returns mean of the refitted loc and scale
+    'percentile' or 'bca' return (loclow, lochigh), (scalelow, scalehigh)
+    '''
+    Values = ParametricNormal(loc, scale, N, Runs=Runs, interval=interval,
+                              alpha=alpha, chunksize=chunksize, seed=seed)
+    if verbose > 0:
+        print("Parametric bootstrap gives", Values)
+    return Values
 
 
 def RandomSample(xdata, cdf, NSamples, verbose=0):
@@ -893,31 +1522,40 @@ def RandomSample(xdata, cdf, NSamples, verbose=0):
     return array(Sample)
 
 
+@Instrumented('EmpiricalBootstrap')
 def EmpiricalBootstrap(rawdata, fitscale, filename, NRuns=500, timerange=(
-        -500, 500), dt=25, GenerateImages=True, ImageKey="", FetchData=False, verbose=0):
+        -500, 500), dt=25, GenerateImages=True, ImageKey="", FetchData=False,
+        method='mle', plotspecs=None, seed=None, verbose=0):
     '''
     Empirical Bootstrap using ECDF
+
+    NRuns resamples are drawn from the ECDF of rawdata in one go
+    method : 'mle' reduces every resample with a closed form binned Gaussian
+    MLE (bin width dt over timerange), 'curvefit' fits each one with normfit
+    GenerateImages : True draws inline, 'deferred' records a plot spec into plotspecs
+    seed : None, integer or RandomState
     '''
 
     ScaleRange = (fitscale - 20, fitscale + 20)
     smin, smax = ScaleRange
     X = linspace(smin, smax, 1000)
 
-    ecdf = sm.distributions.ECDF(rawdata)  # step 1, find ECDF
-    ParameterValues = []
-    for _ in range(NRuns):
-        # step 2, generate new sample
-        RndSample = RandomSample(ecdf.x, ecdf.y, NSamples=len(rawdata))
-
-        Values, Frequency = zip(*stats.itemfreq(RndSample))
-        Frequency = array(Frequency, dtype=float)
-
-        (param, err), chival = normfit(Values, Frequency, yerr=sqrt(Frequency),
-                                       ScaleGuess=100, verbose=verbose)  # step 3, fit to CTR peak
-
-        p1, p2, p3 = param
-
-        ParameterValues.append(param)
+    if method == 'mle':
+        ParameterValues = EmpiricalNormal(rawdata, NRuns=NRuns, binrange=timerange,
+                                          dt=dt, seed=seed)
+    elif method == 'curvefit':
+        ParameterValues = []
+        for Block in EmpiricalSamples(rawdata, len(rawdata), NRuns, seed=seed):
+            for RndSample in Block:
+                Values, Frequency = zip(*stats.itemfreq(RndSample))
+                Values = array(Values, dtype=float)
+                Frequency = array(Frequency, dtype=float)
+
+                (param, err), chival = normfit(Values, Frequency, yerr=sqrt(Frequency),
+                                               ScaleGuess=100, verbose=verbose)  # fit to CTR peak
+                ParameterValues.append(param)
+    else:
+        raise KeyError("Unknown method " + str(method))
 
     if FetchData:
         return zip(*ParameterValues)
@@ -931,7 +1569,7 @@ def EmpiricalBootstrap(rawdata, fitscale, filename, NRuns=500, timerange=(
     p1, p2, p3 = param
 
     if GenerateImages:
-        fig = figure()
+        fig = _Figure(GenerateImages)
         ax = fig.add_subplot(111)
         ax.set_title("Empirical Bootstrap")
         ax.step(BinEdges, Freq)
@@ -963,7 +1601,7 @@ def EmpiricalBootstrap(rawdata, fitscale, filename, NRuns=500, timerange=(
                 'empiricalbootstrap' +
                 '.' +
                 Ext)
-        show()
+        _ShowFigure(fig, plotspecs)
 
     if verbose > 0:
         print("Empirical Bootstrap gives", p2)
@@ -973,12 +1611,56 @@ def EmpiricalBootstrap(rawdata, fitscale, filename, NRuns=500, timerange=(
 # ErrorType='scikits',Combined=False,workingon='reference',,,SelectIndices=0):
 
 
+def _ProcessRun(job):
+    '''
+    Fits a single run for ProcessFiles. Any exception is caught and returned
+    as its traceback string so one bad run can't kill the whole batch
+
+    returns result, the run's Instrumentation (None unless instrument is set)
+    and its deferred plot specs
+    '''
+    fs, un, kwargs = job
+    record = EnableInstrumentation() if kwargs.get('instrument', False) else None
+    specs = []
+    try:
+        result = DelayPeakFitting(fs, un, **dict(kwargs, plotspecs=specs))
+    except Exception:
+        result = traceback.format_exc()
+    if record is not None:
+        DisableInstrumentation()
+    return result, record, specs
+
+
+# ProcessFiles kwargs that don't change the fitted values
+_NonAnalysisKwargs = set(['workers', 'instrument', 'incremental', 'verbose', 'GenerateImages',
+                          'imageformats', 'ImageKey', 'plotspecs', 'memo', 'chunksize'])
+
+
+def AnalysisHash(kwargs):
+    '''
+    sha1 of the ProcessFiles kwargs that change the fitted values
+    '''
+    Analysis = sorted((key, val) for key, val in kwargs.items() if key not in _NonAnalysisKwargs)
+    return hashlib.sha1(repr(Analysis).encode('utf-8')).hexdigest()
+
+
 def ProcessFiles(fileloc, **kwargs):
     '''
     Processes CTR data files from standard and DOI CTR measurements
 
     skipfirst (True) : ignores 00000 events - typically a short run to
     wait for temperature to stabilise (but not always!)
+    workers (1) : number of processes to fit runs with (None uses every core)
+    instrument (False) : record per stage timings and counters over the batch,
+    saved as <workingon>-<ErrorType>-timings.json and returned
+    GenerateImages (False) : figures are recorded while fitting and rendered
+    on Agg afterwards (by workers processes), show() is never called
+    imageformats (None) : only render these extensions (default Extensions)
+    incremental (False) : reuse rows of the existing csv whose run files
+    (fingerprint), analysis kwargs (kwargshash) and code (codeversion) are
+    unchanged, only new or changed runs are fitted
+    memo (False) : True reuses photopeak fits and edge masks across calls
+    through each process's SharedMemo (set MemoLocation to share them on disk)
     '''
 
     workingon = kwargs.get("workingon", "DOI")
@@ -986,33 +1668,111 @@ def ProcessFiles(fileloc, **kwargs):
     splitby = kwargs.get('splitby', '_0')
     skipfirst = kwargs.get('skipfirst', True)
     Combined = kwargs.get('Combined', False)
+    workers = kwargs.get('workers', 1)
+    instrument = kwargs.get('instrument', False)
+    imageformats = kwargs.get('imageformats', None)
+    incremental = kwargs.get('incremental', False)
     verbose = kwargs.get('verbose', 0)
 
+    if workers is None:
+        workers = cpu_count()
+
+    if kwargs.get('GenerateImages', False):
+        kwargs = dict(kwargs, GenerateImages='deferred')
+
     if Combined: #literally combine all files (bar skipfirst)
         CombineFiles(fileloc, splitby=splitby, verbose=verbose)
         fileloc += '-Combined'
-        kwargs = dict(kwargs.items() + [('SkipRows', 0)])
+        kwargs = dict(kwargs, SkipRows=0)
     else:
-        kwargs = dict(kwargs.items() + [('SkipRows', 4)])
+        kwargs = dict(kwargs, SkipRows=4)
 
-    GeneratedData = []
     # BORING :P
     UniqueNames, Files = Fetchfile(fileloc, skipfirst=skipfirst, verbose=0)
-    GeneratedData += [DelayPeakFitting(fs, un, **kwargs)
-                      for fs, un in zip(Files, UniqueNames)]
-    show()
+    outputfile = fileloc + '/' + workingon + '-' + ErrorType + '.csv'
+
+    Keys = {"kwargshash": AnalysisHash(kwargs), "codeversion": CodeVersion()}
+    Fingerprints = {un: RunFingerprint(fs) for fs, un in zip(Files, UniqueNames)}
+
+    Previous = None
+    if incremental and os.path.exists(outputfile):
+        try:
+            Previous = pds.read_csv(outputfile, index_col=0)
+        except ValueError:  # empty file
+            pass
+    if Previous is not None and 'uniquename' not in Previous:
+        Previous = None  # a batch that failed entirely writes no rows
+    if Previous is not None:
+        Previous = Previous[Previous.uniquename.isin(Fingerprints)]  # drops runs no longer on disk
+        Valid = Previous.uniquename.map(Fingerprints) == Previous.get('fingerprint')
+        for key, val in Keys.items():
+            Valid &= Previous.get(key) == val
+        Reuse = set(Previous.uniquename[Valid])
+        if verbose > 0:
+            print("Reusing", len(Reuse), "of", len(Fingerprints), "runs")
+    else:
+        Reuse = set()
+
+    Jobs = [(fs, un, kwargs) for fs, un in zip(Files, UniqueNames) if un not in Reuse]
+
+    if workers > 1:
+        pool = Pool(workers)
+        try:
+            # map keeps results in the same order as the runs
+            Results = pool.map(_ProcessRun, Jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        Results = [_ProcessRun(job) for job in Jobs]
+
+    PlotSpecs = [spec for gi, record, specs in Results for spec in specs]
+    RenderStart = default_timer()
+    if PlotSpecs:
+        RenderFigures(PlotSpecs, workers=workers, extensions=imageformats, verbose=verbose)
+    RenderTime = default_timer() - RenderStart
+
+    GeneratedData = [gi for gi, record, specs in Results]
+    for (fs, un, _), gi in zip(Jobs, GeneratedData):
+        if isinstance(gi, str):
+            print(un, "failed :")
+            print(gi)
+        elif isinstance(gi, dict):
+            gi.update(Keys, fingerprint=Fingerprints[un])
+
+    if instrument:
+        Timings = Instrumentation()
+        for gi, record, specs in Results:
+            Timings.merge(record)
+        Timings.add('render', 'calls')
+        Timings.add('render', 'figures', len(PlotSpecs))
+        Timings.add('render', 'walltime', RenderTime)
+        Timings.add('ProcessFiles', 'runs', len(Results))
+        Timings.add('ProcessFiles', 'reused', len(Reuse))
+        Timings.add('ProcessFiles', 'failed', sum(not isinstance(gi, dict) for gi in GeneratedData))
+        Timings.to_json(fileloc + '/' + workingon + '-' + ErrorType + '-timings.json')
+        if verbose > 0:
+            print(Timings.table())
 
     # gets rid of failed events
     GeneratedData = [gi for gi in GeneratedData if isinstance(gi, dict)]
 
     try:
         df = pds.DataFrame(GeneratedData)
-        df.to_csv(fileloc + '/' + workingon + '-' + ErrorType + '.csv')
+        if Previous is not None:
+            # refitted runs replace their old rows, every other row is kept
+            Refitted = set(un for fs, un, _ in Jobs)
+            df = pds.concat([Previous[~Previous.uniquename.isin(Refitted)], df])
+            df = df.sort_values('uniquename').reset_index(drop=True)
+        df.to_csv(outputfile)
         print("Complete!")
     except AttributeError:
         print("failed to create dataframe")
         print(GeneratedData)
 
+    if instrument:
+        return Timings
+
 
 def FetchDataFrame(rootloc, workingon,
                    Combined=False, ErrorType='scikits', verbose=0):
@@ -1037,47 +1797,48 @@ def FetchDataFrame(rootloc, workingon,
         return 1
 
 
-def GenerateCTR(df, reference=ufloat(42, 2), refflag=True, verbose=0):
+def GenerateCTR(df, reference=None, refflag=True, verbose=0):
     '''
     Calculates time resolution and error from scale parameter
+    reference : reference detector time resolution subtracted in quadrature (ufloat(42, 2))
+    refflag : subtract reference, otherwise the detectors are identical and
+    the scale is divided by sqrt(2)
+
+    Errors are propagated to first order (as uncertainties does) with array
+    arithmetic. Scales not above the reference give 0 with a NaN error
+
+    returns arrays of time resolution and error
     '''
-#    TotalSigma = [ufloat(grp.scale, grp.scaleerr)
-#                  for key, grp in df.groupby('uniquename')]
-    
-    
+    scale = df["scale"].values.astype(float)
+    scaleerr = df["scaleerr"].values.astype(float)
 
     if refflag==True:
-        def afunc(srs):
-                if srs["scale"]>reference.nominal_value:
-                    return ufloat(srs["scale"], srs["scaleerr"])
-                else:
-                    return reference.nominal_value
-                  
-        TotalSigma = array(df.apply(afunc,axis=1))
+        if reference is None:
+            ref, referr = 42.0, 2.0
+        else:
+            ref, referr = reference.nominal_value, reference.std_dev
 
         if verbose > 0:
-            print("Subtracting",reference,"in quadrature!")
-                        
-        TimeResolution = [uncmath.sqrt(val**2 - reference**2) for val in TotalSigma]
-    
-    else:
-        def afunc(srs):
-            return ufloat(srs["scale"], srs["scaleerr"])
-            
-        TotalSigma = array(df.apply(afunc,axis=1))
+            print("Subtracting", ref, "+/-", referr, "in quadrature!")
+
+        # d/dv sqrt(v**2 - r**2) = v / res and d/dr = -r / res
+        Clamped = ~(scale > ref)
+        with errstate(divide='ignore', invalid='ignore'):
+            TimeResolution = sqrt(where(Clamped, 0.0, scale ** 2 - ref ** 2))
+            Error = sqrt((scale * scaleerr) ** 2 + (ref * referr) ** 2) / TimeResolution
+        Error[Clamped] = nan
 
+    else:
         if verbose > 0:
             print("identical scintillator detectors")
-        TimeResolution = [val / uncmath.sqrt(2) for val in TotalSigma]
+        TimeResolution = scale / sqrt(2)
+        Error = abs(scaleerr) / sqrt(2)
 
     if verbose > 0:
-        for i, val in enumerate(TimeResolution):
-            print(i, ":", val, "ps")
+        for i, (val, err) in enumerate(zip(TimeResolution, Error)):
+            print(i, ":", val, "+/-", err, "ps")
 
-        ##print("\nmean value :", mean(TimeResolution), "ps")
-    
-    return zip(*[[val.n, val.s] for val in TimeResolution])
-    #return zip(*[[val.nominal_value, val.std_dev] for val in TimeResolution])
+    return TimeResolution, Error
 
 
 def CalculateDOI(df, minposition=34, whichkey='KeyWords', verbose=0):
@@ -0,0 +1,196 @@
+from __future__ import print_function, division
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pds
+from pandas.api.types import is_numeric_dtype
+from .instrument import Count
+
+__all__ = ['FileFingerprint', 'RunFingerprint', 'LoadCachedChannel', 'PruneCache', 'ClearCache']
+
+
+def FileFingerprint(fileloc):
+    '''
+    (absolute path, mtime, size) identifying the current contents of a file
+    '''
+    st = os.stat(fileloc)
+    return os.path.abspath(fileloc), st.st_mtime, st.st_size
+
+
+def RunFingerprint(filenames):
+    '''
+    sha1 of the FileFingerprint of every channel file of a run
+    (filenames : dict of channel : file location as from Fetchfile)
+    '''
+    Prints = [[j] + list(FileFingerprint(filenames[j])) for j in sorted(filenames)]
+    return hashlib.sha1(json.dumps(Prints).encode('utf-8')).hexdigest()
+
+
+def _EntryLocation(fileloc, SkipRows, cacheloc):
+    '''
+    Each file (and SkipRows) gets its own cache directory, which is
+    overwritten whenever the file's mtime or size change
+    '''
+    key = os.path.abspath(fileloc) + '|' + str(SkipRows)
+    return os.path.join(cacheloc, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _ReadEntry(entryloc, fingerprint, SkipRows, columns, mmap):
+    '''
+    Returns cached DataFrame or None if missing or stale
+    '''
+    try:
+        with open(os.path.join(entryloc, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    path, mtime, size = fingerprint
+    if (meta['path'], meta['mtime'], meta['size'], meta['SkipRows']) != (path, mtime, size, SkipRows):
+        return None
+
+    if columns is None:
+        columns = meta['columns']
+
+    mmap_mode = 'r' if mmap else None
+    try:
+        index = np.load(os.path.join(entryloc, 'index.npy'), mmap_mode=mmap_mode)
+        data = {col: np.load(os.path.join(entryloc, 'col%d.npy' % meta['columns'].index(col)),
+                             mmap_mode=mmap_mode) for col in columns}
+    except (IOError, OSError, ValueError):  # evicted or cleared by another process
+        return None
+    if meta['indexkind'] == 'str':
+        index = index.astype(object)
+    try:
+        os.utime(os.path.join(entryloc, 'meta.json'), None)  # recently used, see PruneCache
+    except OSError:
+        pass
+
+    df = pds.DataFrame(data, index=pds.Index(index, name=meta['indexname']),
+                       columns=columns)
+    return df
+
+
+def _WriteEntry(entryloc, fingerprint, SkipRows, df):
+    '''
+    Writes into a temporary directory first so concurrent workers never
+    see a half written entry
+    '''
+    path, mtime, size = fingerprint
+    tmploc = entryloc + '.tmp%d' % os.getpid()
+    if os.path.exists(tmploc):
+        shutil.rmtree(tmploc)
+    os.makedirs(tmploc)
+
+    if not is_numeric_dtype(df.index):  # object or (pandas >= 2) str dtype
+        indexkind = 'str'
+        np.save(os.path.join(tmploc, 'index.npy'), np.asarray(df.index, dtype=str))
+    else:
+        indexkind = 'numeric'
+        np.save(os.path.join(tmploc, 'index.npy'), df.index.values)
+
+    columns = [str(col) for col in df.columns]
+    for i, col in enumerate(df.columns):
+        np.save(os.path.join(tmploc, 'col%d.npy' % i), df[col].values)
+
+    meta = {'path': path, 'mtime': mtime, 'size': size, 'SkipRows': SkipRows,
+            'columns': columns, 'indexname': df.index.name, 'indexkind': indexkind}
+    with open(os.path.join(tmploc, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        if os.path.exists(entryloc):
+            shutil.rmtree(entryloc)
+        os.rename(tmploc, entryloc)
+    except OSError:  # another process got there first
+        shutil.rmtree(tmploc, ignore_errors=True)
+
+
+def LoadCachedChannel(fileloc, cacheloc, SkipRows=4, columns=None, mmap=True,
+                      sep=';', maxsize=None, verbose=0):
+    '''
+    Reads an oscilloscope channel file through a binary (.npy) cache
+
+    fileloc : scope .txt file
+    cacheloc : directory holding the cache
+    SkipRows : cropped guff out of data files
+    columns : only these columns are loaded from the cache (default all)
+    mmap : memory map cached columns rather than reading them in
+    maxsize : bytes the cache may hold, PruneCache runs after each new entry
+    (None never evicts)
+
+    Entries are keyed by path, mtime and size so a changed file is
+    re-parsed automatically
+    '''
+    fingerprint = FileFingerprint(fileloc)
+    entryloc = _EntryLocation(fileloc, SkipRows, cacheloc)
+
+    df = _ReadEntry(entryloc, fingerprint, SkipRows, columns, mmap)
+    if df is not None:
+        Count('LoadChannel', 'cachehits')
+        if verbose > 1:
+            print("cache hit :", fileloc)
+        return df
+
+    Count('LoadChannel', 'cachemisses')
+    if verbose > 1:
+        print("cache miss :", fileloc)
+
+    df = pds.read_csv(fileloc, skiprows=SkipRows, sep=sep, index_col=0)
+    try:
+        os.makedirs(cacheloc)
+    except OSError:  # already exists
+        pass
+    _WriteEntry(entryloc, fingerprint, SkipRows, df)
+    if maxsize is not None:
+        PruneCache(cacheloc, maxsize, verbose=verbose)
+
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def PruneCache(cacheloc, maxsize, verbose=0):
+    '''
+    Removes cached channels whose file no longer exists, then the least
+    recently used until the cache holds at most maxsize bytes
+
+    returns number of entries removed
+    '''
+    Entries = []
+    for name in os.listdir(cacheloc):
+        entryloc = os.path.join(cacheloc, name)
+        try:
+            with open(os.path.join(entryloc, 'meta.json')) as f:
+                path = json.load(f)['path']
+            lastused = os.stat(os.path.join(entryloc, 'meta.json')).st_mtime
+            size = sum(os.path.getsize(os.path.join(entryloc, afile))
+                       for afile in os.listdir(entryloc))
+        except (IOError, OSError, ValueError, KeyError):  # not an entry, or being written
+            continue
+        Entries.append((not os.path.exists(path), lastused, size, entryloc))
+
+    # missing files first, then oldest first
+    Entries.sort(key=lambda entry: (not entry[0], entry[1]))
+    total = sum(size for missing, lastused, size, entryloc in Entries)
+    Removed = 0
+    for missing, lastused, size, entryloc in Entries:
+        if not missing and total <= maxsize:
+            break
+        shutil.rmtree(entryloc, ignore_errors=True)
+        total -= size
+        Removed += 1
+
+    if verbose > 0 and Removed:
+        print("Removed", Removed, "cached channels")
+    return Removed
+
+
+def ClearCache(cacheloc):
+    '''
+    Removes every cached channel
+    '''
+    if os.path.exists(cacheloc):
+        shutil.rmtree(cacheloc)
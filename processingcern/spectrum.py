@@ -0,0 +1,53 @@
+from __future__ import print_function, division
+from numpy import histogram, linspace, zeros
+
+__all__ = ['Spectrum']
+
+
+class Spectrum(object):
+    '''
+    Histogram with fixed edges that can be grown as data streams in
+
+    binrange : (min, max) as numpy.histogram's range
+    Bins : number of bins
+
+    add(batch) and merge(other) accumulate in place and nonzero() returns
+    the (freq, centres, mask) with empty bins dropped that the fitting
+    stages work from
+    '''
+
+    def __init__(self, binrange, Bins):
+        self.binrange = tuple(binrange)
+        self.Bins = int(Bins)
+        self.freq = zeros(self.Bins, dtype=int)
+
+        xmin, xmax = self.binrange
+        self.edges = linspace(xmin, xmax, self.Bins + 1)
+        self.centres = 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    def __len__(self):
+        return int(self.freq.sum())
+
+    def add(self, batch):
+        '''
+        bins batch (values outside binrange are ignored, as numpy.histogram)
+        '''
+        freq, edges = histogram(batch, bins=self.Bins, range=self.binrange)
+        self.freq += freq
+        return self
+
+    def merge(self, other):
+        '''
+        adds the counts of another Spectrum with identical edges
+        '''
+        if (other.binrange, other.Bins) != (self.binrange, self.Bins):
+            raise ValueError("Spectra must share binrange and Bins to merge")
+        self.freq += other.freq
+        return self
+
+    def nonzero(self):
+        '''
+        returns freq, centres of non empty bins and the mask selecting them
+        '''
+        mask = self.freq > 0
+        return self.freq[mask], self.centres[mask], mask
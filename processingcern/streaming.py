@@ -0,0 +1,59 @@
+from __future__ import print_function, division
+import pandas as pds
+from numpy import inf
+
+__all__ = ['StreamChunkSize', 'StreamRun']
+
+StreamChunkSize = 100000  # rows read from each channel file at once
+
+
+def StreamRun(filenames, channels, SkipRows=4, chunksize=None, sep=';'):
+    '''
+    Yields a run a chunk at a time as DataFrames with a column per channel on
+    a shared event axis (outer join, NaN where a channel missed an event) as
+    RunData.data holds it
+
+    filenames : Dict of filenames generated by FetchFile
+    channels : channels to read
+    chunksize : rows read from a file at once (StreamChunkSize)
+
+    Events are only yielded once every channel has read past them and only
+    the channels furthest behind are read from, so memory is bounded by a
+    few chunks per channel. The event index must increase through each file
+    (as the scope and CombineFiles write them)
+    '''
+    if chunksize is None:
+        chunksize = StreamChunkSize
+
+    channels = list(channels)
+    Readers = {j: iter(pds.read_csv(filenames[j], skiprows=SkipRows, sep=sep,
+                                    index_col=0, chunksize=chunksize)) for j in channels}
+    Buffers = {j: pds.Series([], dtype=float) for j in channels}
+    Last = {j: -inf for j in channels}  # last event read from each file
+
+    while Readers:
+        Behind = min(Last[j] for j in Readers)
+        for j in [j for j in Readers if Last[j] == Behind]:
+            try:
+                Ampl = next(Readers[j]).Ampl
+            except StopIteration:
+                del Readers[j]
+                continue
+            if len(Ampl) == 0:
+                continue
+            if not Ampl.index.is_monotonic_increasing or Ampl.index[0] <= Last[j]:
+                raise ValueError("Event index must increase through " + str(filenames[j]))
+            Buffers[j] = pds.concat([Buffers[j], Ampl.astype(float)]) if len(Buffers[j]) else Ampl.astype(float)
+            Last[j] = Ampl.index[-1]
+
+        # every channel has read up to limit (or finished)
+        limit = min(Last[j] for j in Readers) if Readers else inf
+        Ready = []
+        for j in channels:
+            buff = Buffers[j]
+            pos = buff.index.searchsorted(limit, side='right') if limit < inf else len(buff)
+            Ready.append(buff.iloc[:pos])
+            Buffers[j] = buff.iloc[pos:]
+
+        if any(len(ready) for ready in Ready):
+            yield pds.concat(Ready, axis=1, keys=channels)